@@ -0,0 +1,83 @@
+-- ===================================================
+-- Regression Check: Item-Detail and Category-Browse Queries Stay Index-Backed
+-- ===================================================
+
+-- EXPLAINs the queries the app and the ingest scripts rely on and fails if any
+-- plan still scans one of the listed tables sequentially. Sequential scans are
+-- disabled for the check, so the planner only falls back to one when no index
+-- can serve the query; the result therefore does not depend on how much data
+-- the database holds. Nothing is executed or modified. Run it after schema
+-- changes, e.g. psql -v ON_ERROR_STOP=1 -f SQL/check_query_plans.sql.
+
+BEGIN;
+
+SET LOCAL enable_seqscan = off;
+
+DO
+$$
+DECLARE
+    v_case     RECORD;
+    v_plan     JSONB;
+    v_failures TEXT[] := '{}';
+BEGIN
+    FOR v_case IN
+        SELECT *
+        FROM (VALUES
+            ('item detail: images of an item', 'images',
+             'SELECT * FROM public.images WHERE heritage_item_id = ''00000000-0000-0000-0000-000000000000''::UUID'),
+            ('item detail: videos of an item', 'videos',
+             'SELECT * FROM public.videos WHERE heritage_item_id = ''00000000-0000-0000-0000-000000000000''::UUID'),
+            ('item detail: item with its media by uid', 'images',
+             'SELECT h.id, i.image_url, v.video_url
+              FROM public.heritage_items h
+              LEFT JOIN public.images i ON i.heritage_item_id = h.id
+              LEFT JOIN public.videos v ON v.heritage_item_id = h.id
+              WHERE h.uid = ''0'''),
+            ('item detail: item with its media by uid', 'videos',
+             'SELECT h.id, i.image_url, v.video_url
+              FROM public.heritage_items h
+              LEFT JOIN public.images i ON i.heritage_item_id = h.id
+              LEFT JOIN public.videos v ON v.heritage_item_id = h.id
+              WHERE h.uid = ''0'''),
+            ('cascade: images of a deleted item', 'images',
+             'DELETE FROM public.images WHERE heritage_item_id = ''00000000-0000-0000-0000-000000000000''::UUID'),
+            ('cascade: videos of a deleted item', 'videos',
+             'DELETE FROM public.videos WHERE heritage_item_id = ''00000000-0000-0000-0000-000000000000''::UUID'),
+            -- Served by the index of UNIQUE (name, parent_id); name is its leading column
+            ('category browse: category by name and level', 'categories',
+             'SELECT id FROM public.categories WHERE name = ''0'' AND level = 2'),
+            ('category browse: children of a category', 'categories',
+             'SELECT id, name FROM public.categories WHERE parent_id = 0'),
+            ('category browse: items in a level-1 category', 'heritage_items',
+             'SELECT id, name FROM public.heritage_items WHERE category1_id = 0'),
+            ('category browse: items in a level-2 category', 'heritage_items',
+             'SELECT id, name FROM public.heritage_items WHERE category2_id = 0'),
+            ('category browse: items in a level-3 category', 'heritage_items',
+             'SELECT id, name FROM public.heritage_items WHERE category3_id = 0'),
+            ('category browse: items in a level-4 category', 'heritage_items',
+             'SELECT id, name FROM public.heritage_items WHERE category4_id = 0'),
+            ('category browse: items under a category by name', 'heritage_items',
+             'SELECT h.id, h.name
+              FROM public.categories c
+              JOIN public.heritage_items h ON h.category2_id = c.id
+              WHERE c.name = ''0'' AND c.level = 2'),
+            ('sync: active items modified since a date', 'heritage_items',
+             'SELECT uid FROM public.heritage_items WHERE canceled = FALSE AND last_modified >= DATE ''2000-01-01''')
+        ) AS c (label, relation, query)
+    LOOP
+        EXECUTE 'EXPLAIN (FORMAT JSON) ' || v_case.query INTO v_plan;
+        IF jsonb_path_exists(v_plan, '$.** ? (@."Node Type" == "Seq Scan" && @."Relation Name" == $rel)',
+                             jsonb_build_object('rel', v_case.relation)) THEN
+            v_failures := v_failures || format('%s (sequential scan on %s)', v_case.label, v_case.relation);
+        ELSE
+            RAISE NOTICE 'ok: % (%)', v_case.label, v_case.relation;
+        END IF;
+    END LOOP;
+
+    IF cardinality(v_failures) > 0 THEN
+        RAISE EXCEPTION 'Queries without a usable index: %', array_to_string(v_failures, '; ');
+    END IF;
+END
+$$;
+
+ROLLBACK;
@@ -0,0 +1,57 @@
+-- ===================================================
+-- Migration: Make Category Creation Race-Free
+-- ===================================================
+
+-- UNIQUE (name, parent_id) treats every NULL parent_id as distinct, so parallel
+-- ingest workers could create the same level-1 category twice. This migration
+-- merges existing duplicates level by level (repointing heritage_items and child
+-- categories to the oldest row) and replaces the constraint with
+-- UNIQUE NULLS NOT DISTINCT (PostgreSQL 15+), which get_or_create_category and
+-- insert_heritage_items_bulk rely on for ON CONFLICT (name, parent_id).
+-- Run it once on databases created before this change, then re-run
+-- set_up_insertion_rule.sql.
+
+BEGIN;
+
+LOCK TABLE public.categories IN SHARE ROW EXCLUSIVE MODE;
+
+-- Merging parents can make their children collide, so the old constraint goes first
+ALTER TABLE public.categories DROP CONSTRAINT IF EXISTS categories_name_parent_id_key;
+
+DO
+$$
+DECLARE
+    v_level INTEGER;
+BEGIN
+    FOR v_level IN 1..4 LOOP
+        DROP TABLE IF EXISTS category_merge;
+        CREATE TEMP TABLE category_merge AS
+        SELECT id, keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY name, parent_id) AS keep_id
+              FROM public.categories
+              WHERE level = v_level) d
+        WHERE id <> keep_id;
+
+        EXECUTE format(
+            'UPDATE public.heritage_items h SET category%1$s_id = m.keep_id
+             FROM category_merge m WHERE h.category%1$s_id = m.id', v_level);
+
+        UPDATE public.categories c
+        SET parent_id = m.keep_id
+        FROM category_merge m
+        WHERE c.parent_id = m.id;
+
+        DELETE FROM public.categories c
+        USING category_merge m
+        WHERE c.id = m.id;
+
+        RAISE NOTICE 'Merged % duplicate categories at level %', (SELECT count(*) FROM category_merge), v_level;
+    END LOOP;
+    DROP TABLE IF EXISTS category_merge;
+END
+$$;
+
+ALTER TABLE public.categories
+    ADD CONSTRAINT categories_name_parent_id_key UNIQUE NULLS NOT DISTINCT (name, parent_id);
+
+COMMIT;
@@ -0,0 +1,45 @@
+-- ===================================================
+-- Migration: Indexes for Media Joins and Category Queries
+-- ===================================================
+
+-- Adds the indexes of set_up_table.sql section 10 that databases created before
+-- them are missing. Without them every item-with-media query and every
+-- ON DELETE CASCADE from heritage_items scans images and videos sequentially,
+-- and category browsing scans heritage_items and categories.
+-- CREATE INDEX CONCURRENTLY does not block ingest, but it cannot run inside a
+-- transaction block: run this file as plain statements (e.g. psql without
+-- --single-transaction), then run check_query_plans.sql.
+-- A failed concurrent build leaves an INVALID index behind; drop it and re-run.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_images_heritage_item_id
+    ON public.images (heritage_item_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_videos_heritage_item_id
+    ON public.videos (heritage_item_id);
+
+-- Earlier versions of this migration built a (name, level) index; the index of
+-- the UNIQUE (name, parent_id) constraint already serves lookups by name
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_categories_name_level;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_categories_parent_id
+    ON public.categories (parent_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_heritage_items_category1_id
+    ON public.heritage_items (category1_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_heritage_items_category2_id
+    ON public.heritage_items (category2_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_heritage_items_category3_id
+    ON public.heritage_items (category3_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_heritage_items_category4_id
+    ON public.heritage_items (category4_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_heritage_items_canceled_last_modified
+    ON public.heritage_items (canceled, last_modified);
+
+ANALYZE public.images;
+ANALYZE public.videos;
+ANALYZE public.categories;
+ANALYZE public.heritage_items;
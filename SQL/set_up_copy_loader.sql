@@ -0,0 +1,245 @@
+-- ===================================================
+-- 1. Staging Tables for the COPY Loader
+-- ===================================================
+
+-- copy_loader.py streams normalized rows into these tables with COPY and then
+-- merges them into the real tables with merge_staged_heritage_items(). They
+-- are UNLOGGED: their content can always be rebuilt from the API (cache), so
+-- there is no point in writing it to the WAL.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.staging_heritage_items
+(
+    uid                  VARCHAR(255) NOT NULL,
+    name                 VARCHAR(255),
+    name_hanja           VARCHAR(255),
+    city_code            VARCHAR(2),
+    district_code        VARCHAR(2),
+    heritage_type_code   VARCHAR(2),
+    canceled             BOOLEAN,
+    last_modified        DATE,
+    management_number    VARCHAR(50),
+    linkage_number       VARCHAR(50),
+    longitude            DOUBLE PRECISION,
+    latitude             DOUBLE PRECISION,
+    type                 VARCHAR(255),
+    quantity             VARCHAR(255),
+    registered_date      DATE,
+    location_description TEXT,
+    era                  VARCHAR(255),
+    owner                VARCHAR(255),
+    manager              VARCHAR(255),
+    thumbnail            TEXT,
+    content              TEXT,
+    category1_name       VARCHAR(255),
+    category2_name       VARCHAR(255),
+    category3_name       VARCHAR(255),
+    category4_name       VARCHAR(255)
+);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.staging_images
+(
+    uid           VARCHAR(255) NOT NULL,
+    image_license VARCHAR(255),
+    image_url     VARCHAR(1024),
+    description   TEXT
+);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.staging_videos
+(
+    uid       VARCHAR(255) NOT NULL,
+    video_url VARCHAR(1024)
+);
+
+-- Restaging a page replaces its rows by uid (see copy_loader.copy_records)
+CREATE INDEX IF NOT EXISTS idx_staging_heritage_items_uid ON public.staging_heritage_items (uid);
+CREATE INDEX IF NOT EXISTS idx_staging_images_uid ON public.staging_images (uid);
+CREATE INDEX IF NOT EXISTS idx_staging_videos_uid ON public.staging_videos (uid);
+
+-- Staged items that merge_staged_heritage_items() could not load because a
+-- NOT NULL reference (city, district or heritage type) did not resolve
+CREATE TABLE IF NOT EXISTS public.staging_rejected_items
+(
+    uid         VARCHAR(255) PRIMARY KEY,
+    unresolved  TEXT[]                   NOT NULL,
+    rejected_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+-- Definitions of the indexes dropped by defer_secondary_indexes()
+CREATE TABLE IF NOT EXISTS public.staging_deferred_indexes
+(
+    index_name TEXT PRIMARY KEY,
+    definition TEXT NOT NULL
+);
+
+-- ===================================================
+-- 2. Deferred Index Builds
+-- ===================================================
+
+-- Maintaining every secondary index row by row during a full backfill is far
+-- slower than building it once afterwards. defer_secondary_indexes() records
+-- and drops the indexes of heritage_items, images and videos that do not back a
+-- constraint (primary keys and the uid UNIQUE stay, ON CONFLICT needs them);
+-- restore_secondary_indexes() recreates them.
+
+CREATE OR REPLACE FUNCTION public.defer_secondary_indexes()
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_index RECORD;
+    v_count INTEGER := 0;
+BEGIN
+    FOR v_index IN
+        SELECT i.indexrelid::regclass::TEXT AS index_name, pg_get_indexdef(i.indexrelid) AS definition
+        FROM pg_index i
+        WHERE i.indrelid IN ('public.heritage_items'::regclass, 'public.images'::regclass, 'public.videos'::regclass)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+    LOOP
+        INSERT INTO public.staging_deferred_indexes (index_name, definition)
+        VALUES (v_index.index_name, v_index.definition)
+        ON CONFLICT (index_name) DO NOTHING;
+        EXECUTE format('DROP INDEX %s', v_index.index_name);
+        v_count := v_count + 1;
+    END LOOP;
+    RETURN v_count;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.restore_secondary_indexes()
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_index RECORD;
+    v_count INTEGER := 0;
+BEGIN
+    FOR v_index IN SELECT index_name, definition FROM public.staging_deferred_indexes LOOP
+        EXECUTE v_index.definition;
+        DELETE FROM public.staging_deferred_indexes WHERE index_name = v_index.index_name;
+        v_count := v_count + 1;
+    END LOOP;
+    RETURN v_count;
+END;
+$$;
+
+-- ===================================================
+-- 3. Set-Based Merge of the Staged Rows
+-- ===================================================
+
+-- Creates missing categories level by level, inserts every staged item that is
+-- not in heritage_items yet (resolving codes and category names with joins)
+-- and inserts the images and videos of exactly those items. Items whose city,
+-- district or heritage type code does not resolve are written to
+-- staging_rejected_items instead of aborting the whole merge on the NOT NULL
+-- columns. Items that already exist are left untouched; the loader is meant for
+-- first-time population and sync.py keeps the data current afterwards.
+-- Returns the number of new items.
+
+CREATE OR REPLACE FUNCTION public.merge_staged_heritage_items()
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_inserted INTEGER;
+BEGIN
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT s.category1_name, NULL::INTEGER, 1
+    FROM public.staging_heritage_items s
+    WHERE NULLIF(s.category1_name, '') IS NOT NULL
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT s.category2_name, c1.id, 2
+    FROM public.staging_heritage_items s
+    JOIN public.categories c1 ON c1.name = s.category1_name AND c1.parent_id IS NULL
+    WHERE NULLIF(s.category2_name, '') IS NOT NULL
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT s.category3_name, c2.id, 3
+    FROM public.staging_heritage_items s
+    JOIN public.categories c1 ON c1.name = s.category1_name AND c1.parent_id IS NULL
+    JOIN public.categories c2 ON c2.name = s.category2_name AND c2.parent_id = c1.id
+    WHERE NULLIF(s.category3_name, '') IS NOT NULL
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT s.category4_name, c3.id, 4
+    FROM public.staging_heritage_items s
+    JOIN public.categories c1 ON c1.name = s.category1_name AND c1.parent_id IS NULL
+    JOIN public.categories c2 ON c2.name = s.category2_name AND c2.parent_id = c1.id
+    JOIN public.categories c3 ON c3.name = s.category3_name AND c3.parent_id = c2.id
+    WHERE NULLIF(s.category4_name, '') IS NOT NULL
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    -- Resolve every staged item once; rows with a missing reference are split off below
+    CREATE TEMP TABLE staging_resolved ON COMMIT DROP AS
+    SELECT
+        s.*, ci.id AS city_id, d.id AS district_id, ht.id AS heritage_type_id,
+        c1.id AS category1_id, c2.id AS category2_id, c3.id AS category3_id, c4.id AS category4_id
+    FROM (SELECT DISTINCT ON (uid) * FROM public.staging_heritage_items ORDER BY uid) s
+    LEFT JOIN public.cities ci ON ci.code = s.city_code
+    LEFT JOIN public.districts d ON d.city_id = ci.id AND d.code = s.district_code
+    LEFT JOIN public.heritage_types ht ON ht.code = s.heritage_type_code
+    LEFT JOIN public.categories c1 ON c1.name = s.category1_name AND c1.parent_id IS NULL
+    LEFT JOIN public.categories c2 ON c2.name = s.category2_name AND c2.parent_id = c1.id
+    LEFT JOIN public.categories c3 ON c3.name = s.category3_name AND c3.parent_id = c2.id
+    LEFT JOIN public.categories c4 ON c4.name = s.category4_name AND c4.parent_id = c3.id;
+
+    INSERT INTO public.staging_rejected_items (uid, unresolved)
+    SELECT
+        r.uid,
+        array_remove(ARRAY[
+            CASE WHEN r.city_id IS NULL THEN 'city_code:' || COALESCE(r.city_code, 'NULL') END,
+            CASE WHEN r.district_id IS NULL THEN 'district_code:' || COALESCE(r.district_code, 'NULL') END,
+            CASE WHEN r.heritage_type_id IS NULL THEN 'heritage_type_code:' || COALESCE(r.heritage_type_code, 'NULL') END
+        ], NULL)
+    FROM staging_resolved r
+    WHERE r.city_id IS NULL OR r.district_id IS NULL OR r.heritage_type_id IS NULL
+    ON CONFLICT (uid) DO UPDATE SET unresolved = EXCLUDED.unresolved, rejected_at = NOW();
+
+    WITH inserted AS (
+        INSERT INTO public.heritage_items (
+            uid, name, name_hanja, city_id, district_id, heritage_type_id,
+            canceled, last_modified, management_number, linkage_number,
+            longitude, latitude, type, quantity, registered_date,
+            location_description, era, owner, manager, thumbnail, content,
+            category1_id, category2_id, category3_id, category4_id
+        )
+        SELECT
+            r.uid, r.name, r.name_hanja, r.city_id, r.district_id, r.heritage_type_id,
+            r.canceled, r.last_modified, r.management_number, r.linkage_number,
+            NULLIF(r.longitude, 0), NULLIF(r.latitude, 0), r.type, r.quantity, r.registered_date,
+            r.location_description, r.era, r.owner, r.manager, r.thumbnail, r.content,
+            r.category1_id, r.category2_id, r.category3_id, r.category4_id
+        FROM staging_resolved r
+        WHERE r.city_id IS NOT NULL AND r.district_id IS NOT NULL AND r.heritage_type_id IS NOT NULL
+        ON CONFLICT (uid) DO NOTHING
+        RETURNING id, uid
+    ),
+    inserted_images AS (
+        INSERT INTO public.images (heritage_item_id, image_license, image_url, description)
+        SELECT i.id, si.image_license, si.image_url, si.description
+        FROM inserted i
+        JOIN public.staging_images si ON si.uid = i.uid
+    ),
+    inserted_videos AS (
+        INSERT INTO public.videos (heritage_item_id, video_url)
+        SELECT i.id, sv.video_url
+        FROM inserted i
+        JOIN public.staging_videos sv ON sv.uid = i.uid
+    )
+    SELECT count(*) INTO v_inserted FROM inserted;
+
+    -- Items that resolve now (e.g. after a reference table fix) are no longer rejected
+    DELETE FROM public.staging_rejected_items x
+    USING staging_resolved r
+    WHERE x.uid = r.uid
+      AND r.city_id IS NOT NULL AND r.district_id IS NOT NULL AND r.heritage_type_id IS NOT NULL;
+
+    RETURN v_inserted;
+END;
+$$;
@@ -2,6 +2,45 @@
 -- 2. Updated Stored Procedure to Handle Nullable Categories
 -- ===================================================
 
+-- Drop the previous signatures so that PostgREST does not see two overloads;
+-- the return type changed as well, which CREATE OR REPLACE cannot do
+DROP FUNCTION IF EXISTS public.insert_heritage_item_with_relations(
+    VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, BOOLEAN, DATE, VARCHAR, VARCHAR,
+    DOUBLE PRECISION, DOUBLE PRECISION, VARCHAR, VARCHAR, DATE, TEXT, VARCHAR, VARCHAR, VARCHAR,
+    TEXT, TEXT, VARCHAR, VARCHAR, VARCHAR, VARCHAR, JSONB, JSONB
+);
+DROP FUNCTION IF EXISTS public.insert_heritage_item_with_relations(
+    VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, BOOLEAN, DATE, VARCHAR, VARCHAR,
+    DOUBLE PRECISION, DOUBLE PRECISION, VARCHAR, VARCHAR, DATE, TEXT, VARCHAR, VARCHAR, VARCHAR,
+    TEXT, TEXT, VARCHAR, VARCHAR, VARCHAR, VARCHAR, JSONB, JSONB, BOOLEAN
+);
+-- The current signature returns heritage_item_insert_result, so it has to go before the type
+DROP FUNCTION IF EXISTS public.insert_heritage_item_with_relations(
+    VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, VARCHAR, BOOLEAN, DATE, VARCHAR, VARCHAR,
+    DOUBLE PRECISION, DOUBLE PRECISION, VARCHAR, VARCHAR, DATE, TEXT, VARCHAR, VARCHAR, VARCHAR,
+    TEXT, TEXT, VARCHAR, VARCHAR, VARCHAR, VARCHAR, JSONB, JSONB, BOOLEAN, BOOLEAN
+);
+
+-- Result row of insert_heritage_item_with_relations. status is 'inserted',
+-- 'updated', 'unchanged' or 'rejected'; unresolved lists the codes that matched
+-- no reference row, e.g. {'city_code:99'}. city_id, district_id and
+-- heritage_type_id are NOT NULL, so an item with any of them unresolved is
+-- rejected without being written.
+DROP TYPE IF EXISTS public.heritage_item_insert_result;
+CREATE TYPE public.heritage_item_insert_result AS
+(
+    heritage_item_id UUID,
+    status           TEXT,
+    city_id          INTEGER,
+    district_id      INTEGER,
+    heritage_type_id INTEGER,
+    category1_id     INTEGER,
+    category2_id     INTEGER,
+    category3_id     INTEGER,
+    category4_id     INTEGER,
+    unresolved       TEXT[]
+);
+
 CREATE OR REPLACE FUNCTION public.insert_heritage_item_with_relations(
     p_uid VARCHAR,
     p_name VARCHAR,
@@ -29,9 +68,11 @@ CREATE OR REPLACE FUNCTION public.insert_heritage_item_with_relations(
     p_category3_name VARCHAR,
     p_category4_name VARCHAR,
     p_images JSONB,  -- Array of JSON objects with 'licence', 'image_url', 'description'
-    p_videos JSONB   -- Array of video URLs
+    p_videos JSONB,  -- Array of video URLs
+    p_upsert BOOLEAN DEFAULT FALSE,  -- Update an existing uid instead of failing on the UNIQUE constraint
+    p_verbose BOOLEAN DEFAULT NULL  -- Emit RAISE NOTICE tracing; NULL follows the heritage.debug setting (off by default)
 )
-RETURNS VOID
+RETURNS public.heritage_item_insert_result
 LANGUAGE plpgsql
 SET search_path = public, pg_catalog  -- Explicitly set search_path here
 AS $$
@@ -44,6 +85,11 @@ DECLARE
     v_category2_id INTEGER;
     v_category3_id INTEGER;
     v_category4_id INTEGER;
+    v_was_inserted BOOLEAN;
+    v_changed BOOLEAN;
+    v_unresolved TEXT[] := '{}';
+    v_result public.heritage_item_insert_result;
+    v_verbose BOOLEAN := COALESCE(p_verbose, NULLIF(current_setting('heritage.debug', TRUE), '')::BOOLEAN, FALSE);
 BEGIN
     -- Removed SET search_path = public; from here
 
@@ -54,104 +100,114 @@ BEGIN
         -- Attempt to retrieve city_id; set to NULL if not found
         SELECT id INTO v_city_id FROM public.cities WHERE code = p_city_code;
         IF v_city_id IS NULL THEN
-            RAISE NOTICE 'City code % not found. Setting city_id to NULL.', p_city_code;
+            v_unresolved := v_unresolved || ('city_code:' || COALESCE(p_city_code, 'NULL'));
+            IF v_verbose THEN RAISE NOTICE 'City code % not found. Setting city_id to NULL.', p_city_code; END IF;
         ELSE
-            RAISE NOTICE 'Resolved city_id: % for city_code: %', v_city_id, p_city_code;
+            IF v_verbose THEN RAISE NOTICE 'Resolved city_id: % for city_code: %', v_city_id, p_city_code; END IF;
         END IF;
 
         -- Attempt to retrieve district_id; set to NULL if not found
         IF v_city_id IS NOT NULL THEN
             SELECT id INTO v_district_id FROM public.districts WHERE city_id = v_city_id AND code = p_district_code;
             IF v_district_id IS NULL THEN
-                RAISE NOTICE 'District code % not found for city_id %. Setting district_id to NULL.', p_district_code, v_city_id;
+                v_unresolved := v_unresolved || ('district_code:' || COALESCE(p_district_code, 'NULL'));
+                IF v_verbose THEN RAISE NOTICE 'District code % not found for city_id %. Setting district_id to NULL.', p_district_code, v_city_id; END IF;
             ELSE
-                RAISE NOTICE 'Resolved district_id: % for district_code: % and city_id: %', v_district_id, p_district_code, v_city_id;
+                IF v_verbose THEN RAISE NOTICE 'Resolved district_id: % for district_code: % and city_id: %', v_district_id, p_district_code, v_city_id; END IF;
             END IF;
         ELSE
-            RAISE NOTICE 'City_id is NULL. Setting district_id to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'City_id is NULL. Setting district_id to NULL.'; END IF;
             v_district_id := NULL;
         END IF;
 
         -- Attempt to retrieve heritage_type_id; set to NULL if not found
         SELECT id INTO v_heritage_type_id FROM public.heritage_types WHERE code = p_heritage_type_code;
         IF v_heritage_type_id IS NULL THEN
-            RAISE NOTICE 'Heritage type code % not found. Setting heritage_type_id to NULL.', p_heritage_type_code;
+            v_unresolved := v_unresolved || ('heritage_type_code:' || COALESCE(p_heritage_type_code, 'NULL'));
+            IF v_verbose THEN RAISE NOTICE 'Heritage type code % not found. Setting heritage_type_id to NULL.', p_heritage_type_code; END IF;
         ELSE
-            RAISE NOTICE 'Resolved heritage_type_id: % for heritage_type_code: %', v_heritage_type_id, p_heritage_type_code;
+            IF v_verbose THEN RAISE NOTICE 'Resolved heritage_type_id: % for heritage_type_code: %', v_heritage_type_id, p_heritage_type_code; END IF;
+        END IF;
+
+        -- The reference columns are NOT NULL; report the item instead of failing on the constraint
+        IF v_city_id IS NULL OR v_district_id IS NULL OR v_heritage_type_id IS NULL THEN
+            IF v_verbose THEN RAISE NOTICE 'Rejecting heritage_item with uid %: unresolved %', p_uid, v_unresolved; END IF;
+            v_result := ROW(NULL, 'rejected', v_city_id, v_district_id, v_heritage_type_id,
+                            NULL, NULL, NULL, NULL, v_unresolved);
+            RETURN v_result;
         END IF;
 
+        -- An existing uid that the upsert below would leave untouched must not create
+        -- categories either, so that case is answered before the categories are resolved.
+        -- The ON CONFLICT below still covers a concurrent insert of the same uid.
+        SELECT id, category1_id, category2_id, category3_id, category4_id,
+               last_modified IS DISTINCT FROM p_last_modified OR canceled IS DISTINCT FROM p_canceled
+        INTO v_heritage_item_id, v_category1_id, v_category2_id, v_category3_id, v_category4_id, v_changed
+        FROM public.heritage_items
+        WHERE uid = p_uid;
+
+        IF v_heritage_item_id IS NOT NULL AND NOT (p_upsert AND v_changed) THEN
+            IF NOT p_upsert THEN
+                RAISE EXCEPTION 'duplicate key value violates unique constraint: uid % already exists', p_uid
+                    USING ERRCODE = 'unique_violation';
+            END IF;
+            IF v_verbose THEN RAISE NOTICE 'heritage_item with uid % is unchanged. Skipping.', p_uid; END IF;
+            v_result := ROW(v_heritage_item_id, 'unchanged', v_city_id, v_district_id, v_heritage_type_id,
+                            v_category1_id, v_category2_id, v_category3_id, v_category4_id, v_unresolved);
+            RETURN v_result;
+        END IF;
+        v_heritage_item_id := NULL;
+
         -- Handle Category1
         IF p_category1_name IS NOT NULL AND p_category1_name <> '' THEN
-            SELECT id INTO v_category1_id FROM public.categories WHERE name = p_category1_name AND level = 1;
-            IF v_category1_id IS NULL THEN
-                INSERT INTO public.categories (name, parent_id, level) VALUES (p_category1_name, NULL, 1)
-                RETURNING id INTO v_category1_id;
-                RAISE NOTICE 'Inserted new category1_id: %', v_category1_id;
-            ELSE
-                RAISE NOTICE 'Found existing category1_id: %', v_category1_id;
-            END IF;
+            v_category1_id := public.get_or_create_category(p_category1_name, NULL, 1);
+            IF v_verbose THEN RAISE NOTICE 'Resolved category1_id: %', v_category1_id; END IF;
         ELSE
-            RAISE NOTICE 'Category1 name is NULL or empty. Setting category1_id to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Category1 name is NULL or empty. Setting category1_id to NULL.'; END IF;
             v_category1_id := NULL;
         END IF;
 
         -- Handle Category2
         IF p_category2_name IS NOT NULL AND p_category2_name <> '' AND v_category1_id IS NOT NULL THEN
-            SELECT id INTO v_category2_id FROM public.categories WHERE name = p_category2_name AND parent_id = v_category1_id AND level = 2;
-            IF v_category2_id IS NULL THEN
-                INSERT INTO public.categories (name, parent_id, level) VALUES (p_category2_name, v_category1_id, 2)
-                RETURNING id INTO v_category2_id;
-                RAISE NOTICE 'Inserted new category2_id: %', v_category2_id;
-            ELSE
-                RAISE NOTICE 'Found existing category2_id: %', v_category2_id;
-            END IF;
+            v_category2_id := public.get_or_create_category(p_category2_name, v_category1_id, 2);
+            IF v_verbose THEN RAISE NOTICE 'Resolved category2_id: %', v_category2_id; END IF;
         ELSE
-            RAISE NOTICE 'Category2 name is NULL or empty, or parent category1_id is NULL. Setting category2_id to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Category2 name is NULL or empty, or parent category1_id is NULL. Setting category2_id to NULL.'; END IF;
             v_category2_id := NULL;
         END IF;
 
         -- Handle Category3
         IF p_category3_name IS NOT NULL AND p_category3_name <> '' AND v_category2_id IS NOT NULL THEN
-            SELECT id INTO v_category3_id FROM public.categories WHERE name = p_category3_name AND parent_id = v_category2_id AND level = 3;
-            IF v_category3_id IS NULL THEN
-                INSERT INTO public.categories (name, parent_id, level) VALUES (p_category3_name, v_category2_id, 3)
-                RETURNING id INTO v_category3_id;
-                RAISE NOTICE 'Inserted new category3_id: %', v_category3_id;
-            ELSE
-                RAISE NOTICE 'Found existing category3_id: %', v_category3_id;
-            END IF;
+            v_category3_id := public.get_or_create_category(p_category3_name, v_category2_id, 3);
+            IF v_verbose THEN RAISE NOTICE 'Resolved category3_id: %', v_category3_id; END IF;
         ELSE
-            RAISE NOTICE 'Category3 name is NULL or empty, or parent category2_id is NULL. Setting category3_id to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Category3 name is NULL or empty, or parent category2_id is NULL. Setting category3_id to NULL.'; END IF;
             v_category3_id := NULL;
         END IF;
 
         -- Handle Category4
         IF p_category4_name IS NOT NULL AND p_category4_name <> '' AND v_category3_id IS NOT NULL THEN
-            SELECT id INTO v_category4_id FROM public.categories WHERE name = p_category4_name AND parent_id = v_category3_id AND level = 4;
-            IF v_category4_id IS NULL THEN
-                INSERT INTO public.categories (name, parent_id, level) VALUES (p_category4_name, v_category3_id, 4)
-                RETURNING id INTO v_category4_id;
-                RAISE NOTICE 'Inserted new category4_id: %', v_category4_id;
-            ELSE
-                RAISE NOTICE 'Found existing category4_id: %', v_category4_id;
-            END IF;
+            v_category4_id := public.get_or_create_category(p_category4_name, v_category3_id, 4);
+            IF v_verbose THEN RAISE NOTICE 'Resolved category4_id: %', v_category4_id; END IF;
         ELSE
-            RAISE NOTICE 'Category4 name is NULL or empty, or parent category3_id is NULL. Setting category4_id to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Category4 name is NULL or empty, or parent category3_id is NULL. Setting category4_id to NULL.'; END IF;
             v_category4_id := NULL;
         END IF;
 
         -- Handle longitude and latitude: set to NULL if 0
         IF p_longitude = 0 THEN
             p_longitude := NULL;
-            RAISE NOTICE 'Longitude is 0. Setting to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Longitude is 0. Setting to NULL.'; END IF;
         END IF;
 
         IF p_latitude = 0 THEN
             p_latitude := NULL;
-            RAISE NOTICE 'Latitude is 0. Setting to NULL.';
+            IF v_verbose THEN RAISE NOTICE 'Latitude is 0. Setting to NULL.'; END IF;
         END IF;
 
-        -- Insert into heritage_items
+        -- Insert into heritage_items.
+        -- In upsert mode an existing uid is updated only when its last_modified or canceled flag changed;
+        -- otherwise no row is returned and the item is left untouched.
         INSERT INTO public.heritage_items (
             uid, name, name_hanja, city_id, district_id, heritage_type_id,
             canceled, last_modified, management_number, linkage_number,
@@ -165,8 +221,57 @@ BEGIN
             p_location_description, p_era, p_owner, p_manager, p_thumbnail, p_content,
             v_category1_id, v_category2_id, v_category3_id, v_category4_id
         )
-        RETURNING id INTO v_heritage_item_id;
-        RAISE NOTICE 'Inserted heritage_item_id: % for uid: %', v_heritage_item_id, p_uid;
+        ON CONFLICT (uid) DO UPDATE SET
+            name = EXCLUDED.name,
+            name_hanja = EXCLUDED.name_hanja,
+            city_id = EXCLUDED.city_id,
+            district_id = EXCLUDED.district_id,
+            heritage_type_id = EXCLUDED.heritage_type_id,
+            canceled = EXCLUDED.canceled,
+            last_modified = EXCLUDED.last_modified,
+            management_number = EXCLUDED.management_number,
+            linkage_number = EXCLUDED.linkage_number,
+            longitude = EXCLUDED.longitude,
+            latitude = EXCLUDED.latitude,
+            type = EXCLUDED.type,
+            quantity = EXCLUDED.quantity,
+            registered_date = EXCLUDED.registered_date,
+            location_description = EXCLUDED.location_description,
+            era = EXCLUDED.era,
+            owner = EXCLUDED.owner,
+            manager = EXCLUDED.manager,
+            thumbnail = EXCLUDED.thumbnail,
+            content = EXCLUDED.content,
+            category1_id = EXCLUDED.category1_id,
+            category2_id = EXCLUDED.category2_id,
+            category3_id = EXCLUDED.category3_id,
+            category4_id = EXCLUDED.category4_id,
+            updated_at = NOW()
+        WHERE p_upsert
+          AND (public.heritage_items.last_modified IS DISTINCT FROM EXCLUDED.last_modified
+               OR public.heritage_items.canceled IS DISTINCT FROM EXCLUDED.canceled)
+        RETURNING id, (xmax = 0) INTO v_heritage_item_id, v_was_inserted;  -- xmax is 0 only for a fresh insert
+
+        v_result := ROW(v_heritage_item_id, NULL, v_city_id, v_district_id, v_heritage_type_id,
+                        v_category1_id, v_category2_id, v_category3_id, v_category4_id, v_unresolved);
+
+        IF v_heritage_item_id IS NULL THEN
+            IF NOT p_upsert THEN
+                RAISE EXCEPTION 'duplicate key value violates unique constraint: uid % already exists', p_uid
+                    USING ERRCODE = 'unique_violation';
+            END IF;
+            IF v_verbose THEN RAISE NOTICE 'heritage_item with uid % is unchanged. Skipping.', p_uid; END IF;
+            v_result.status := 'unchanged';
+            RETURN v_result;
+        END IF;
+        v_result.status := CASE WHEN v_was_inserted THEN 'inserted' ELSE 'updated' END;
+        IF v_verbose THEN RAISE NOTICE 'Inserted heritage_item_id: % for uid: %', v_heritage_item_id, p_uid; END IF;
+
+        -- Replace the media of an updated item; this runs in the same transaction as the insert
+        IF p_upsert THEN
+            DELETE FROM public.images WHERE heritage_item_id = v_heritage_item_id;
+            DELETE FROM public.videos WHERE heritage_item_id = v_heritage_item_id;
+        END IF;
 
         -- Insert Images
         IF p_images IS NOT NULL THEN
@@ -178,7 +283,7 @@ BEGIN
                 img->>'description'
             FROM jsonb_array_elements(p_images) AS img
             WHERE (img->>'image_url') IS NOT NULL AND (img->>'image_url') <> '';
-            RAISE NOTICE 'Inserted images for heritage_item_id: %', v_heritage_item_id;
+            IF v_verbose THEN RAISE NOTICE 'Inserted images for heritage_item_id: %', v_heritage_item_id; END IF;
         END IF;
 
         -- Insert Videos
@@ -189,12 +294,470 @@ BEGIN
                 vid->>'video_url'
             FROM jsonb_array_elements(p_videos) AS vid
             WHERE (vid->>'video_url') IS NOT NULL AND (vid->>'video_url') <> '';
-            RAISE NOTICE 'Inserted videos for heritage_item_id: %', v_heritage_item_id;
+            IF v_verbose THEN RAISE NOTICE 'Inserted videos for heritage_item_id: %', v_heritage_item_id; END IF;
         END IF;
-
-    EXCEPTION WHEN OTHERS THEN
-        -- If any error occurs, propagate the error
-        RAISE;
     END;
+
+    RETURN v_result;
+END;
+$$;
+
+-- ===================================================
+-- 3. Set-Based Bulk Insert for a Whole Search Page
+-- ===================================================
+
+-- p_items is a JSON array of objects using the same field names as the
+-- single-item procedure without the 'p_' prefix, e.g.
+--   [{"uid": "...", "name": "...", "city_code": "11", ...,
+--     "category1_name": "...", "images": [...], "videos": [...]}]
+-- Lookups, category creation and media inserts are done once per batch
+-- instead of once per item. With p_upsert, existing uids whose last_modified
+-- or canceled flag changed are updated and their images and videos replaced; unchanged ones are
+-- skipped. Items whose city, district or heritage type code does not resolve
+-- are left out instead of failing the whole batch on the NOT NULL columns.
+-- Returns {"affected": <inserted or updated heritage_items>,
+--          "rejected": [{"uid": ..., "unresolved": ["city_code:99", ...]}, ...]}.
+DROP FUNCTION IF EXISTS public.insert_heritage_items_bulk(JSONB);
+-- The return type changed from INTEGER, which CREATE OR REPLACE cannot do
+DROP FUNCTION IF EXISTS public.insert_heritage_items_bulk(JSONB, BOOLEAN);
+
+CREATE OR REPLACE FUNCTION public.insert_heritage_items_bulk(
+    p_items JSONB,
+    p_upsert BOOLEAN DEFAULT FALSE
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_inserted INTEGER;
+    v_expected INTEGER;
+    v_rejected JSONB;
+BEGIN
+    IF p_items IS NULL OR jsonb_array_length(p_items) = 0 THEN
+        RETURN jsonb_build_object('affected', 0, 'rejected', '[]'::JSONB);
+    END IF;
+
+    -- Create missing categories level by level so that every parent exists
+    -- before its children are inserted.
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT item->>'category1_name', NULL::INTEGER, 1
+    FROM jsonb_array_elements(p_items) AS item
+    WHERE NULLIF(item->>'category1_name', '') IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM public.categories c
+          WHERE c.name = item->>'category1_name' AND c.level = 1
+      )
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT item->>'category2_name', c1.id, 2
+    FROM jsonb_array_elements(p_items) AS item
+    JOIN LATERAL (
+        SELECT id FROM public.categories
+        WHERE name = item->>'category1_name' AND level = 1
+        ORDER BY id LIMIT 1
+    ) c1 ON TRUE
+    WHERE NULLIF(item->>'category2_name', '') IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM public.categories c
+          WHERE c.name = item->>'category2_name' AND c.parent_id = c1.id AND c.level = 2
+      )
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT item->>'category3_name', c2.id, 3
+    FROM jsonb_array_elements(p_items) AS item
+    JOIN LATERAL (
+        SELECT id FROM public.categories
+        WHERE name = item->>'category1_name' AND level = 1
+        ORDER BY id LIMIT 1
+    ) c1 ON TRUE
+    JOIN public.categories c2
+        ON c2.name = item->>'category2_name' AND c2.parent_id = c1.id AND c2.level = 2
+    WHERE NULLIF(item->>'category3_name', '') IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM public.categories c
+          WHERE c.name = item->>'category3_name' AND c.parent_id = c2.id AND c.level = 3
+      )
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    SELECT DISTINCT item->>'category4_name', c3.id, 4
+    FROM jsonb_array_elements(p_items) AS item
+    JOIN LATERAL (
+        SELECT id FROM public.categories
+        WHERE name = item->>'category1_name' AND level = 1
+        ORDER BY id LIMIT 1
+    ) c1 ON TRUE
+    JOIN public.categories c2
+        ON c2.name = item->>'category2_name' AND c2.parent_id = c1.id AND c2.level = 2
+    JOIN public.categories c3
+        ON c3.name = item->>'category3_name' AND c3.parent_id = c2.id AND c3.level = 3
+    WHERE NULLIF(item->>'category4_name', '') IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM public.categories c
+          WHERE c.name = item->>'category4_name' AND c.parent_id = c3.id AND c.level = 4
+      )
+    ON CONFLICT (name, parent_id) DO NOTHING;
+
+    -- Insert all heritage_items, then their images and videos, in one statement
+    WITH src AS (
+        SELECT DISTINCT ON (x.uid) *
+        FROM jsonb_to_recordset(p_items) AS x(
+            uid VARCHAR,
+            name VARCHAR,
+            name_hanja VARCHAR,
+            city_code VARCHAR,
+            district_code VARCHAR,
+            heritage_type_code VARCHAR,
+            canceled BOOLEAN,
+            last_modified DATE,
+            management_number VARCHAR,
+            linkage_number VARCHAR,
+            longitude DOUBLE PRECISION,
+            latitude DOUBLE PRECISION,
+            type VARCHAR,
+            quantity VARCHAR,
+            registered_date DATE,
+            location_description TEXT,
+            era VARCHAR,
+            owner VARCHAR,
+            manager VARCHAR,
+            thumbnail TEXT,
+            content TEXT,
+            category1_name VARCHAR,
+            category2_name VARCHAR,
+            category3_name VARCHAR,
+            category4_name VARCHAR,
+            images JSONB,
+            videos JSONB
+        )
+        ORDER BY x.uid
+    ),
+    resolved AS (
+        SELECT s.*, ci.id AS city_id, d.id AS district_id, ht.id AS heritage_type_id
+        FROM src s
+        LEFT JOIN public.cities ci ON ci.code = s.city_code
+        LEFT JOIN public.districts d ON d.city_id = ci.id AND d.code = s.district_code
+        LEFT JOIN public.heritage_types ht ON ht.code = s.heritage_type_code
+    ),
+    inserted AS (
+        INSERT INTO public.heritage_items (
+            uid, name, name_hanja, city_id, district_id, heritage_type_id,
+            canceled, last_modified, management_number, linkage_number,
+            longitude, latitude, type, quantity, registered_date,
+            location_description, era, owner, manager, thumbnail, content,
+            category1_id, category2_id, category3_id, category4_id
+        )
+        SELECT
+            s.uid, s.name, s.name_hanja, s.city_id, s.district_id, s.heritage_type_id,
+            s.canceled, s.last_modified, s.management_number, s.linkage_number,
+            NULLIF(s.longitude, 0), NULLIF(s.latitude, 0), s.type, s.quantity, s.registered_date,
+            s.location_description, s.era, s.owner, s.manager, s.thumbnail, s.content,
+            c1.id, c2.id, c3.id, c4.id
+        FROM resolved s
+        LEFT JOIN LATERAL (
+            SELECT id FROM public.categories
+            WHERE name = s.category1_name AND level = 1
+            ORDER BY id LIMIT 1
+        ) c1 ON TRUE
+        LEFT JOIN public.categories c2
+            ON c2.name = s.category2_name AND c2.parent_id = c1.id AND c2.level = 2
+        LEFT JOIN public.categories c3
+            ON c3.name = s.category3_name AND c3.parent_id = c2.id AND c3.level = 3
+        LEFT JOIN public.categories c4
+            ON c4.name = s.category4_name AND c4.parent_id = c3.id AND c4.level = 4
+        WHERE s.city_id IS NOT NULL AND s.district_id IS NOT NULL AND s.heritage_type_id IS NOT NULL
+        ON CONFLICT (uid) DO UPDATE SET
+            name = EXCLUDED.name,
+            name_hanja = EXCLUDED.name_hanja,
+            city_id = EXCLUDED.city_id,
+            district_id = EXCLUDED.district_id,
+            heritage_type_id = EXCLUDED.heritage_type_id,
+            canceled = EXCLUDED.canceled,
+            last_modified = EXCLUDED.last_modified,
+            management_number = EXCLUDED.management_number,
+            linkage_number = EXCLUDED.linkage_number,
+            longitude = EXCLUDED.longitude,
+            latitude = EXCLUDED.latitude,
+            type = EXCLUDED.type,
+            quantity = EXCLUDED.quantity,
+            registered_date = EXCLUDED.registered_date,
+            location_description = EXCLUDED.location_description,
+            era = EXCLUDED.era,
+            owner = EXCLUDED.owner,
+            manager = EXCLUDED.manager,
+            thumbnail = EXCLUDED.thumbnail,
+            content = EXCLUDED.content,
+            category1_id = EXCLUDED.category1_id,
+            category2_id = EXCLUDED.category2_id,
+            category3_id = EXCLUDED.category3_id,
+            category4_id = EXCLUDED.category4_id,
+            updated_at = NOW()
+        WHERE p_upsert
+          AND (public.heritage_items.last_modified IS DISTINCT FROM EXCLUDED.last_modified
+               OR public.heritage_items.canceled IS DISTINCT FROM EXCLUDED.canceled)
+        RETURNING id, uid
+    ),
+    -- Sub-statements share one snapshot, so these deletes only see the media
+    -- that existed before this call, never the rows inserted below.
+    deleted_images AS (
+        DELETE FROM public.images
+        WHERE p_upsert AND heritage_item_id IN (SELECT id FROM inserted)
+    ),
+    deleted_videos AS (
+        DELETE FROM public.videos
+        WHERE p_upsert AND heritage_item_id IN (SELECT id FROM inserted)
+    ),
+    inserted_images AS (
+        INSERT INTO public.images (heritage_item_id, image_license, image_url, description)
+        SELECT i.id, img->>'licence', img->>'image_url', img->>'description'
+        FROM inserted i
+        JOIN src s ON s.uid = i.uid
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(s.images, '[]'::JSONB)) AS img
+        WHERE (img->>'image_url') IS NOT NULL AND (img->>'image_url') <> ''
+    ),
+    inserted_videos AS (
+        INSERT INTO public.videos (heritage_item_id, video_url)
+        SELECT i.id, vid->>'video_url'
+        FROM inserted i
+        JOIN src s ON s.uid = i.uid
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(s.videos, '[]'::JSONB)) AS vid
+        WHERE (vid->>'video_url') IS NOT NULL AND (vid->>'video_url') <> ''
+    )
+    SELECT
+        count(*),
+        (SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                    'uid', r.uid,
+                    'unresolved', array_remove(ARRAY[
+                        CASE WHEN r.city_id IS NULL
+                             THEN 'city_code:' || COALESCE(r.city_code, 'NULL') END,
+                        CASE WHEN r.city_id IS NOT NULL AND r.district_id IS NULL
+                             THEN 'district_code:' || COALESCE(r.district_code, 'NULL') END,
+                        CASE WHEN r.heritage_type_id IS NULL
+                             THEN 'heritage_type_code:' || COALESCE(r.heritage_type_code, 'NULL') END
+                    ], NULL))), '[]'::JSONB)
+         FROM resolved r
+         WHERE r.city_id IS NULL OR r.district_id IS NULL OR r.heritage_type_id IS NULL)
+    INTO v_inserted, v_rejected
+    FROM inserted;
+
+    -- Without upsert, an existing uid is an error just like in the single-item procedure
+    IF NOT p_upsert THEN
+        SELECT count(DISTINCT item->>'uid') INTO v_expected FROM jsonb_array_elements(p_items) AS item;
+        v_expected := v_expected - jsonb_array_length(v_rejected);
+        IF v_inserted < v_expected THEN
+            RAISE EXCEPTION 'duplicate key value violates unique constraint: % of % uids already exist',
+                v_expected - v_inserted, v_expected
+                USING ERRCODE = 'unique_violation';
+        END IF;
+    END IF;
+
+    RETURN jsonb_build_object('affected', v_inserted, 'rejected', v_rejected);
+END;
+$$;
+
+-- ===================================================
+-- 4. Category Get-or-Create and Bulk Insert with Resolved Ids
+-- ===================================================
+
+-- The ingest scripts keep cities, districts, heritage_types and the category
+-- tree in memory (lookups.py) and send integer ids instead of codes and names.
+-- A category missing from the client's tree is created once through
+-- get_or_create_category, which returns the id of the existing or new row.
+-- Existing categories (the common case) are found by a plain SELECT, so no
+-- speculative insert burns a categories SERIAL value. On a miss it is safe
+-- under concurrency: UNIQUE NULLS NOT DISTINCT (name, parent_id) also covers
+-- level-1 rows, ON CONFLICT DO NOTHING waits for a concurrent insert of the
+-- same category instead of failing, and the second SELECT (a new snapshot
+-- under READ COMMITTED) then sees the committed row.
+CREATE OR REPLACE FUNCTION public.get_or_create_category(
+    p_name VARCHAR,
+    p_parent_id INTEGER,
+    p_level INTEGER
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_category_id INTEGER;
+BEGIN
+    SELECT id INTO v_category_id
+    FROM public.categories
+    WHERE name = p_name AND parent_id IS NOT DISTINCT FROM p_parent_id;
+    IF v_category_id IS NOT NULL THEN
+        RETURN v_category_id;
+    END IF;
+
+    INSERT INTO public.categories (name, parent_id, level)
+    VALUES (p_name, p_parent_id, p_level)
+    ON CONFLICT (name, parent_id) DO NOTHING
+    RETURNING id INTO v_category_id;
+
+    IF v_category_id IS NULL THEN
+        SELECT id INTO v_category_id
+        FROM public.categories
+        WHERE name = p_name AND parent_id IS NOT DISTINCT FROM p_parent_id;
+    END IF;
+
+    RETURN v_category_id;
+END;
+$$;
+
+-- Same as insert_heritage_items_bulk, but every record already carries city_id,
+-- district_id, heritage_type_id and category1_id .. category4_id instead of the
+-- codes and category names, so no lookups or category inserts run per batch.
+-- lookups.py leaves out records whose city, district or heritage type did not
+-- resolve; any that still carry a NULL reference are rejected, not inserted.
+DROP FUNCTION IF EXISTS public.insert_resolved_heritage_items_bulk(JSONB, BOOLEAN);
+
+CREATE OR REPLACE FUNCTION public.insert_resolved_heritage_items_bulk(
+    p_items JSONB,
+    p_upsert BOOLEAN DEFAULT FALSE
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SET search_path = public, pg_catalog
+AS $$
+DECLARE
+    v_inserted INTEGER;
+    v_expected INTEGER;
+    v_rejected JSONB;
+BEGIN
+    IF p_items IS NULL OR jsonb_array_length(p_items) = 0 THEN
+        RETURN jsonb_build_object('affected', 0, 'rejected', '[]'::JSONB);
+    END IF;
+
+    WITH src AS (
+        SELECT DISTINCT ON (x.uid) *
+        FROM jsonb_to_recordset(p_items) AS x(
+            uid VARCHAR,
+            name VARCHAR,
+            name_hanja VARCHAR,
+            city_id INTEGER,
+            district_id INTEGER,
+            heritage_type_id INTEGER,
+            canceled BOOLEAN,
+            last_modified DATE,
+            management_number VARCHAR,
+            linkage_number VARCHAR,
+            longitude DOUBLE PRECISION,
+            latitude DOUBLE PRECISION,
+            type VARCHAR,
+            quantity VARCHAR,
+            registered_date DATE,
+            location_description TEXT,
+            era VARCHAR,
+            owner VARCHAR,
+            manager VARCHAR,
+            thumbnail TEXT,
+            content TEXT,
+            category1_id INTEGER,
+            category2_id INTEGER,
+            category3_id INTEGER,
+            category4_id INTEGER,
+            images JSONB,
+            videos JSONB
+        )
+        ORDER BY x.uid
+    ),
+    inserted AS (
+        INSERT INTO public.heritage_items (
+            uid, name, name_hanja, city_id, district_id, heritage_type_id,
+            canceled, last_modified, management_number, linkage_number,
+            longitude, latitude, type, quantity, registered_date,
+            location_description, era, owner, manager, thumbnail, content,
+            category1_id, category2_id, category3_id, category4_id
+        )
+        SELECT
+            s.uid, s.name, s.name_hanja, s.city_id, s.district_id, s.heritage_type_id,
+            s.canceled, s.last_modified, s.management_number, s.linkage_number,
+            NULLIF(s.longitude, 0), NULLIF(s.latitude, 0), s.type, s.quantity, s.registered_date,
+            s.location_description, s.era, s.owner, s.manager, s.thumbnail, s.content,
+            s.category1_id, s.category2_id, s.category3_id, s.category4_id
+        FROM src s
+        WHERE s.city_id IS NOT NULL AND s.district_id IS NOT NULL AND s.heritage_type_id IS NOT NULL
+        ON CONFLICT (uid) DO UPDATE SET
+            name = EXCLUDED.name,
+            name_hanja = EXCLUDED.name_hanja,
+            city_id = EXCLUDED.city_id,
+            district_id = EXCLUDED.district_id,
+            heritage_type_id = EXCLUDED.heritage_type_id,
+            canceled = EXCLUDED.canceled,
+            last_modified = EXCLUDED.last_modified,
+            management_number = EXCLUDED.management_number,
+            linkage_number = EXCLUDED.linkage_number,
+            longitude = EXCLUDED.longitude,
+            latitude = EXCLUDED.latitude,
+            type = EXCLUDED.type,
+            quantity = EXCLUDED.quantity,
+            registered_date = EXCLUDED.registered_date,
+            location_description = EXCLUDED.location_description,
+            era = EXCLUDED.era,
+            owner = EXCLUDED.owner,
+            manager = EXCLUDED.manager,
+            thumbnail = EXCLUDED.thumbnail,
+            content = EXCLUDED.content,
+            category1_id = EXCLUDED.category1_id,
+            category2_id = EXCLUDED.category2_id,
+            category3_id = EXCLUDED.category3_id,
+            category4_id = EXCLUDED.category4_id,
+            updated_at = NOW()
+        WHERE p_upsert
+          AND (public.heritage_items.last_modified IS DISTINCT FROM EXCLUDED.last_modified
+               OR public.heritage_items.canceled IS DISTINCT FROM EXCLUDED.canceled)
+        RETURNING id, uid
+    ),
+    deleted_images AS (
+        DELETE FROM public.images
+        WHERE p_upsert AND heritage_item_id IN (SELECT id FROM inserted)
+    ),
+    deleted_videos AS (
+        DELETE FROM public.videos
+        WHERE p_upsert AND heritage_item_id IN (SELECT id FROM inserted)
+    ),
+    inserted_images AS (
+        INSERT INTO public.images (heritage_item_id, image_license, image_url, description)
+        SELECT i.id, img->>'licence', img->>'image_url', img->>'description'
+        FROM inserted i
+        JOIN src s ON s.uid = i.uid
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(s.images, '[]'::JSONB)) AS img
+        WHERE (img->>'image_url') IS NOT NULL AND (img->>'image_url') <> ''
+    ),
+    inserted_videos AS (
+        INSERT INTO public.videos (heritage_item_id, video_url)
+        SELECT i.id, vid->>'video_url'
+        FROM inserted i
+        JOIN src s ON s.uid = i.uid
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(s.videos, '[]'::JSONB)) AS vid
+        WHERE (vid->>'video_url') IS NOT NULL AND (vid->>'video_url') <> ''
+    )
+    SELECT
+        count(*),
+        (SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                    'uid', s.uid,
+                    'unresolved', array_remove(ARRAY[
+                        CASE WHEN s.city_id IS NULL THEN 'city_id:NULL' END,
+                        CASE WHEN s.district_id IS NULL THEN 'district_id:NULL' END,
+                        CASE WHEN s.heritage_type_id IS NULL THEN 'heritage_type_id:NULL' END
+                    ], NULL))), '[]'::JSONB)
+         FROM src s
+         WHERE s.city_id IS NULL OR s.district_id IS NULL OR s.heritage_type_id IS NULL)
+    INTO v_inserted, v_rejected
+    FROM inserted;
+
+    IF NOT p_upsert THEN
+        SELECT count(DISTINCT item->>'uid') INTO v_expected FROM jsonb_array_elements(p_items) AS item;
+        v_expected := v_expected - jsonb_array_length(v_rejected);
+        IF v_inserted < v_expected THEN
+            RAISE EXCEPTION 'duplicate key value violates unique constraint: % of % uids already exist',
+                v_expected - v_inserted, v_expected
+                USING ERRCODE = 'unique_violation';
+        END IF;
+    END IF;
+
+    RETURN jsonb_build_object('affected', v_inserted, 'rejected', v_rejected);
 END;
 $$;
@@ -439,7 +439,7 @@ CREATE TABLE public.categories
     name      VARCHAR(255) NOT NULL,
     parent_id INTEGER REFERENCES public.categories (id) ON DELETE CASCADE,
     level     INTEGER      NOT NULL CHECK (level BETWEEN 1 AND 4),
-    UNIQUE (name, parent_id)
+    UNIQUE NULLS NOT DISTINCT (name, parent_id) -- Level-1 rows (parent_id NULL) are unique by name too
 );
 
 CREATE TABLE public.heritage_items
@@ -518,6 +518,24 @@ CREATE INDEX idx_heritage_items_city_district ON public.heritage_items (city_id,
 -- Geospatial index on location for efficient geospatial queries
 CREATE INDEX idx_heritage_items_location ON public.heritage_items USING GIST(location);
 
+-- Indexes on each category level for category browsing (and for ON DELETE of a category)
+CREATE INDEX idx_heritage_items_category1_id ON public.heritage_items (category1_id);
+CREATE INDEX idx_heritage_items_category2_id ON public.heritage_items (category2_id);
+CREATE INDEX idx_heritage_items_category3_id ON public.heritage_items (category3_id);
+CREATE INDEX idx_heritage_items_category4_id ON public.heritage_items (category4_id);
+
+-- Composite index on canceled and last_modified for active-item and recently-modified queries
+CREATE INDEX idx_heritage_items_canceled_last_modified ON public.heritage_items (canceled, last_modified);
+
+-- Lookups of a category by name (at any level) use the index of the UNIQUE (name, parent_id) constraint
+
+-- Index on categories.parent_id for listing the children of a category (and for its ON DELETE CASCADE)
+CREATE INDEX idx_categories_parent_id ON public.categories (parent_id);
+
+-- Indexes on the media foreign keys for item-with-media queries and the ON DELETE CASCADE from heritage_items
+CREATE INDEX idx_images_heritage_item_id ON public.images (heritage_item_id);
+CREATE INDEX idx_videos_heritage_item_id ON public.videos (heritage_item_id);
+
 -- ===================================================
 -- 11. Make 'cities', 'districts', and 'heritage_types' Tables Immutable
 -- ===================================================
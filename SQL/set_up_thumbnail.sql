@@ -0,0 +1,178 @@
+-- ===================================================
+-- 1. Work-Queue Indexes for the 'thumbnail' Table
+-- ===================================================
+
+-- image_dimention.py and image_optimize.py read their work queues with keyset
+-- pagination (WHERE <filter> AND id > last_id ORDER BY id LIMIT n). These partial
+-- indexes contain only the rows still waiting to be processed, so each page is
+-- an index range scan and the indexes shrink as the work gets done.
+
+-- Thumbnails whose dimensions have not been measured yet
+CREATE INDEX IF NOT EXISTS idx_thumbnail_pending_dimensions
+    ON public.thumbnail (id)
+    WHERE width IS NULL AND height IS NULL;
+
+-- Thumbnails that have not been optimized yet
+CREATE INDEX IF NOT EXISTS idx_thumbnail_pending_optimization
+    ON public.thumbnail (id)
+    WHERE optimized_url IS NULL;
+
+-- ===================================================
+-- 2. Create the 'thumbnail_variants' Table
+-- ===================================================
+
+-- image_optimize.py encodes every thumbnail at several widths and formats from a
+-- single decode. Each variant is uploaded to the 'thumbnail' bucket and recorded
+-- here so clients can pick the smallest image that fits. thumbnail.optimized_url
+-- keeps pointing at the primary (640px WebP) variant.
+
+-- The referencing column takes the type of thumbnail.id, whatever it was created with
+DO
+$$
+DECLARE
+    v_id_type TEXT;
+BEGIN
+    SELECT format_type(a.atttypid, a.atttypmod)
+    INTO v_id_type
+    FROM pg_attribute a
+    WHERE a.attrelid = 'public.thumbnail'::regclass
+      AND a.attname = 'id';
+
+    EXECUTE format($sql$
+        CREATE TABLE IF NOT EXISTS public.thumbnail_variants
+        (
+            id           BIGSERIAL PRIMARY KEY,
+            thumbnail_id %s          NOT NULL REFERENCES public.thumbnail (id) ON DELETE CASCADE,
+            width        INTEGER     NOT NULL, -- Pixel width of the encoded variant
+            height       INTEGER     NOT NULL, -- Pixel height of the encoded variant
+            format       VARCHAR(10) NOT NULL, -- e.g., 'webp', 'avif'
+            url          VARCHAR(1024) NOT NULL,
+            byte_size    INTEGER,
+            created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            UNIQUE (thumbnail_id, width, format) -- One file per size and format; re-runs upsert
+        )$sql$, v_id_type);
+END
+$$;
+
+-- Revoke all privileges on 'thumbnail_variants' from PUBLIC
+REVOKE ALL ON TABLE public.thumbnail_variants FROM PUBLIC;
+
+-- Grant only SELECT privilege on 'thumbnail_variants' to PUBLIC
+GRANT SELECT ON TABLE public.thumbnail_variants TO PUBLIC;
+
+-- ===================================================
+-- 3. Create the Batch Update Function for 'thumbnail'
+-- ===================================================
+
+-- image_dimention.py and image_optimize.py buffer their results and write them
+-- with one call per batch (see thumbnail_writer.py) instead of one UPDATE per
+-- image. p_rows holds objects with an 'id' and any of width, height,
+-- optimized_url, optimized_width, optimized_height, content_hash, dhash
+-- (section 4) and the source_* validators (section 5); columns that are absent
+-- keep their value. p_variants holds thumbnail_variants rows, stored in the same
+-- transaction so optimized_url is never set without its variants. They replace
+-- the variant set of their thumbnail: a refresh may produce fewer widths, and
+-- the widths it no longer produces are deleted. Thumbnails without rows in
+-- p_variants (e.g. from image_dimention.py) keep their variants.
+
+DO
+$$
+DECLARE
+    v_id_type TEXT;
+BEGIN
+    SELECT format_type(a.atttypid, a.atttypmod)
+    INTO v_id_type
+    FROM pg_attribute a
+    WHERE a.attrelid = 'public.thumbnail'::regclass
+      AND a.attname = 'id';
+
+    EXECUTE format($sql$
+        CREATE OR REPLACE FUNCTION public.update_thumbnails_bulk(
+            p_rows JSONB,
+            p_variants JSONB DEFAULT '[]'::JSONB
+        )
+        RETURNS INTEGER
+        LANGUAGE plpgsql
+        SET search_path = public, pg_catalog
+        AS $fn$
+        DECLARE
+            v_updated INTEGER;
+        BEGIN
+            DELETE FROM public.thumbnail_variants tv
+            WHERE tv.thumbnail_id IN (
+                      SELECT (v ->> 'thumbnail_id')::%1$s FROM jsonb_array_elements(p_variants) AS v
+                  )
+              AND NOT EXISTS (
+                      SELECT 1
+                      FROM jsonb_array_elements(p_variants) AS v
+                      WHERE (v ->> 'thumbnail_id')::%1$s = tv.thumbnail_id
+                        AND (v ->> 'width')::INTEGER = tv.width
+                        AND v ->> 'format' = tv.format
+                  );
+
+            INSERT INTO public.thumbnail_variants (thumbnail_id, width, height, format, url, byte_size)
+            SELECT (v ->> 'thumbnail_id')::%1$s,
+                   (v ->> 'width')::INTEGER,
+                   (v ->> 'height')::INTEGER,
+                   v ->> 'format',
+                   v ->> 'url',
+                   (v ->> 'byte_size')::INTEGER
+            FROM jsonb_array_elements(p_variants) AS v
+            ON CONFLICT (thumbnail_id, width, format) DO UPDATE
+                SET height     = EXCLUDED.height,
+                    url        = EXCLUDED.url,
+                    byte_size  = EXCLUDED.byte_size,
+                    created_at = NOW();
+
+            UPDATE public.thumbnail t
+            SET width                 = COALESCE((r ->> 'width')::INTEGER, t.width),
+                height                = COALESCE((r ->> 'height')::INTEGER, t.height),
+                optimized_url         = COALESCE(r ->> 'optimized_url', t.optimized_url),
+                optimized_width       = COALESCE((r ->> 'optimized_width')::INTEGER, t.optimized_width),
+                optimized_height      = COALESCE((r ->> 'optimized_height')::INTEGER, t.optimized_height),
+                content_hash          = COALESCE(r ->> 'content_hash', t.content_hash),
+                dhash                 = COALESCE((r ->> 'dhash')::BIGINT, t.dhash),
+                source_etag           = COALESCE(r ->> 'source_etag', t.source_etag),
+                source_last_modified  = COALESCE(r ->> 'source_last_modified', t.source_last_modified),
+                source_content_length = COALESCE((r ->> 'source_content_length')::BIGINT, t.source_content_length)
+            FROM jsonb_array_elements(p_rows) AS r
+            WHERE t.id = (r ->> 'id')::%1$s;
+
+            GET DIAGNOSTICS v_updated = ROW_COUNT;
+            RETURN v_updated;
+        END;
+        $fn$$sql$, v_id_type);
+END
+$$;
+
+-- ===================================================
+-- 4. Source Image Fingerprints on 'thumbnail'
+-- ===================================================
+
+-- The heritage API reuses the same photo across related items. image_optimize.py
+-- records the SHA-256 of every downloaded source and its 64-bit dHash (stored as
+-- a signed BIGINT), and thumbnails whose source matches an already optimized one
+-- reuse its optimized_url and thumbnail_variants instead of encoding it again.
+
+ALTER TABLE public.thumbnail
+    ADD COLUMN IF NOT EXISTS content_hash CHAR(64), -- SHA-256 of the source image bytes
+    ADD COLUMN IF NOT EXISTS dhash        BIGINT;   -- Perceptual difference hash of the source image
+
+-- Exact-duplicate lookups
+CREATE INDEX IF NOT EXISTS idx_thumbnail_content_hash
+    ON public.thumbnail (content_hash)
+    WHERE content_hash IS NOT NULL;
+
+-- ===================================================
+-- 5. Source Image Validators on 'thumbnail'
+-- ===================================================
+
+-- HTTP validators of the source image, recorded by both image scripts. Later
+-- runs send If-None-Match / If-Modified-Since and skip decoding and uploading
+-- when the image host answers 304 Not Modified (THUMBNAIL_REFRESH=1 revalidates
+-- every processed thumbnail this way).
+
+ALTER TABLE public.thumbnail
+    ADD COLUMN IF NOT EXISTS source_etag           VARCHAR(255), -- ETag response header
+    ADD COLUMN IF NOT EXISTS source_last_modified  VARCHAR(64),  -- Last-Modified response header, as sent
+    ADD COLUMN IF NOT EXISTS source_content_length BIGINT;       -- Size of the source image in bytes
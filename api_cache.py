@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger('main_logger')
+
+# Defaults
+DEFAULT_TTL = 30 * 24 * 3600  # Seconds before an unversioned entry is refetched
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # Cache size above which least recently used entries are evicted
+EVICT_EVERY = 1000  # Number of writes between eviction passes
+
+
+def search_key(result_count: int, page_index: int) -> str:
+    return f"search:{result_count}:{page_index}"
+
+
+def item_key(endpoint: str, uid: str) -> str:
+    """Key of an item response; endpoint is one of 'detail', 'image' or 'video'."""
+    return f"{endpoint}:{uid}"
+
+
+def listing_version(result) -> Optional[str]:
+    """The modification date a search result reports for its item, used for conditional refresh."""
+    value = getattr(result, 'last_modified', None)
+    if value is None:
+        return None
+    if isinstance(value, (time.struct_time, tuple, list)):
+        return time.strftime('%Y-%m-%d', value)
+    return str(value)
+
+
+class ApiCache:
+    """
+    On-disk cache of heritage API responses stored in SQLite.
+    Payloads are pickled and stored once per SHA-256 digest, so identical
+    responses (e.g. the many empty image and video sets) share one blob.
+    Entries expire after a TTL unless they carry a version: a versioned entry
+    stays valid for as long as the caller asks for the same version
+    (conditional refresh) and is refetched as soon as the version changes.
+    """
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES,
+                 offline: bool = False):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline  # Replay from disk only; a miss raises KeyError instead of fetching
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                data   BLOB    NOT NULL,
+                size   INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                key         TEXT PRIMARY KEY,
+                digest      TEXT NOT NULL REFERENCES blobs (digest),
+                version     TEXT,
+                fetched_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_accessed_at ON entries (accessed_at);
+            CREATE INDEX IF NOT EXISTS idx_entries_digest ON entries (digest);
+        """)
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str, version: Optional[str] = None, ttl: Optional[float] = None) -> Optional[Any]:
+        """Return the cached value for key, or None if it is missing, expired or of another version."""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT e.version, e.fetched_at, b.data FROM entries e JOIN blobs b ON b.digest = e.digest "
+                "WHERE e.key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            cached_version, fetched_at, data = row
+            if version is not None:
+                if cached_version != version:
+                    return None
+            elif now - fetched_at > ttl:
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            logger.error(f"Discarding unreadable cache entry {key}: {e}")
+            return None
+
+    def put(self, key: str, value: Any, version: Optional[str] = None) -> None:
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.error(f"Response for {key} cannot be cached: {e}")
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO blobs (digest, data, size) VALUES (?, ?, ?)", (digest, data, len(data)))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, digest, version, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)", (key, digest, version, now, now))
+            self._conn.commit()
+            self._writes += 1
+            evict = self._writes % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any], version: Optional[str] = None,
+                     ttl: Optional[float] = None) -> Any:
+        """Return the cached value for key, calling fetch and storing its result on a miss."""
+        value = self.get(key, version, ttl)
+        if value is not None:
+            logger.debug(f"Cache hit for {key}")
+            return value
+        if self.offline:
+            raise KeyError(f"{key} is not cached and the cache is offline")
+        value = fetch()
+        self.put(key, value, version)
+        return value
+
+    def evict(self) -> None:
+        """Drop expired unversioned entries, then least recently used ones until under max_bytes."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM entries WHERE version IS NULL AND fetched_at < ?", (time.time() - self.ttl,))
+            self._conn.execute("DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)")
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._conn.execute(
+                    "SELECT e.key, b.size FROM entries e JOIN blobs b ON b.digest = e.digest "
+                    "ORDER BY e.accessed_at").fetchall()
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size  # Shared blobs are counted per entry; good enough to bound the size
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", stale)
+                self._conn.execute("DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)")
+                logger.info(f"Evicted {len(stale)} cache entries")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import aiohttp
+
+from auth import BASE_URL, API_KEY, supabase
+from checkpoint import CrawlCheckpoint
+from api_cache import item_key, listing_version
+from init import (logger, invalid_logger, build_heritage_record, bulk_insert_request, fetch_search_page,
+                  resume_crawl, report_insert_result, report_bulk_insert_result, MAX_RETRIES, UPSERT,
+                  CHECKPOINT_PATH, API_RETRY_POLICY, api_cache)
+from kheritageapi.heritage import HeritageInfo
+from kheritageapi.models import HeritagSearchResultItem
+from network import HTTPStatusError, async_call_with_retry, heritage_api_limiter, supabase_limiter
+
+# Constants
+# Throughput is bounded by heritage_api_limiter (HERITAGE_API_RATE requests per second, 20 by default), not by
+# CONCURRENCY: requests in flight settle at about rate x latency, e.g. 20/s x 1 s = 20. Raise HERITAGE_API_RATE
+# (if the API tolerates it) before raising CONCURRENCY.
+CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", 64))  # Upper bound on heritage API requests (and threads) in flight
+PAGE_CONCURRENCY = 4  # Search pages processed at the same time; keeps enough items queued to use CONCURRENCY
+RPC_TIMEOUT = 60  # Seconds to wait for a database RPC
+
+
+async def call_rpc(session: aiohttp.ClientSession, function: str, params: dict):
+    """Call a PostgREST RPC through the shared session, retrying throttling and server errors."""
+    async def attempt():
+        async with session.post(f"{BASE_URL}/rest/v1/rpc/{function}", json=params,
+                                timeout=aiohttp.ClientTimeout(total=RPC_TIMEOUT)) as response:
+            if response.status >= 400:
+                raise HTTPStatusError(response.status, response.headers.get('Retry-After'),
+                                      f"RPC {function} failed with status {response.status}: "
+                                      f"{await response.text()}")
+            return await response.json(content_type=None)
+
+    return await async_call_with_retry(attempt, supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+                                       description=f"RPC {function}")
+
+
+async def insert_records(session: aiohttp.ClientSession, records: List[dict]) -> List[str]:
+    """
+    Insert a page of records with one bulk RPC, falling back to concurrent
+    single-item RPCs if the batch is rejected. Returns the uids that failed.
+    """
+    if not records:
+        return []
+
+    try:
+        # Resolving may load the reference tables or create a category, both blocking calls
+        function, params, rejected = await asyncio.to_thread(bulk_insert_request, records, supabase)
+        if not params['p_items']:
+            return rejected
+        result = await call_rpc(session, function, params)
+        return rejected + report_bulk_insert_result(result, len(records))
+    except Exception as e:
+        logger.error(f"Bulk insert of {len(records)} heritage_items failed: {e}. Falling back to per-item inserts.")
+
+    async def insert_one(record: dict) -> bool:
+        try:
+            result = await call_rpc(session, 'insert_heritage_item_with_relations',
+                                    {**{f'p_{key}': value for key, value in record.items()}, 'p_upsert': UPSERT})
+            if not report_insert_result(record['uid'], result):
+                invalid_logger.warning(f"Invalid data for heritage_item with uid {record['uid']}: {record}")
+                return False
+            return True
+        except Exception as e:
+            logger.error(f"Error inserting heritage_item with uid {record['uid']}: {e}")
+            invalid_logger.warning(f"Invalid data for heritage_item with uid {record['uid']}: {record}")
+            return False
+
+    results = await asyncio.gather(*(insert_one(record) for record in records))
+    return [record['uid'] for record, success in zip(records, results) if not success]
+
+
+async def retrieve_record(result, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    """
+    Retrieve details, images and videos of a search result concurrently.
+    kheritageapi only offers blocking calls, so each request still occupies a thread
+    of the loop's executor while holding one slot of the global semaphore. Cached responses
+    are reused while the listing reports the same last_modified.
+    """
+    version = listing_version(result)
+
+    async def request(endpoint, call):
+        key = item_key(endpoint, result.uid)
+        cached = await asyncio.to_thread(api_cache.get, key, version)
+        if cached is not None:
+            return cached
+
+        async def attempt():
+            async with semaphore:
+                return await asyncio.to_thread(call)
+
+        response = await async_call_with_retry(attempt, heritage_api_limiter, API_RETRY_POLICY,
+                                               description=f"{call.__name__} for uid {result.uid}")
+        await asyncio.to_thread(api_cache.put, key, response, version)
+        return response
+
+    uid = result.uid
+    try:
+        item = HeritageInfo(result)
+        detail, images, videos = await asyncio.gather(
+            request('detail', item.retrieve_detail), request('image', item.retrieve_image),
+            request('video', item.retrieve_video))
+        return build_heritage_record(detail, images, videos)
+    except Exception as e:
+        logger.exception(f"Exception occurred while retrieving heritage_item with uid {uid}: {e}")
+        invalid_logger.warning(
+            f"Exception data for uid {uid}: {result.__dict__ if hasattr(result, '__dict__') else str(result)}")
+        return None
+
+
+async def ingest_page(session: aiohttp.ClientSession, page_index: int, results: HeritagSearchResultItem,
+                      semaphore: asyncio.Semaphore, checkpoint: CrawlCheckpoint) -> None:
+    """Retrieve every item of a search page, insert the page and record it in the checkpoint."""
+    # A page that was already completed is only revisited for the uids that failed
+    items = results.items
+    if page_index in await asyncio.to_thread(checkpoint.completed_pages):
+        retry_uids = await asyncio.to_thread(checkpoint.failed_uids, page_index)
+        items = [result for result in items if result.uid in retry_uids]
+        logger.info(f"Retrying {len(items)} failed items on page {page_index}")
+
+    records = await asyncio.gather(*(retrieve_record(result, semaphore) for result in items))
+    failed_uids = {result.uid for result, record in zip(items, records) if record is None}
+    failed_uids.update(await insert_records(session, [record for record in records if record is not None]))
+    if failed_uids:
+        logger.critical(f"Insertion failed for {len(failed_uids)} heritage_items on page {page_index}.")
+
+    # The checkpoint commits to SQLite on every call, so it is kept off the event loop
+    for uid in failed_uids:
+        await asyncio.to_thread(checkpoint.record_failure, uid, page_index)
+    await asyncio.to_thread(checkpoint.clear_failures,
+                            [result.uid for result in items if result.uid not in failed_uids])
+    await asyncio.to_thread(checkpoint.mark_page_completed, page_index)
+    logger.info(f"Completed page {page_index}")
+
+
+async def main():
+    """
+    Asyncio ingest mode: same crawl and checkpoint as init.py, with every page's items retrieved
+    concurrently up to the HERITAGE_API_RATE limit and inserts sent over one aiohttp session.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=CONCURRENCY))
+
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH, 'init')
+    _, pending_pages, first_results = await asyncio.to_thread(resume_crawl, checkpoint)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    page_semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
+    headers = {
+        'apikey': API_KEY,
+        'Authorization': f'Bearer {API_KEY}',
+        'Content-Type': 'application/json',
+    }
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def process_page(index: int) -> bool:
+            async with page_semaphore:
+                if index == pending_pages[0]:
+                    results = first_results
+                else:
+                    try:
+                        results = await asyncio.to_thread(fetch_search_page, index)
+                    except Exception:
+                        logger.critical(f"Failed to fetch page {index} after {MAX_RETRIES} retries.")
+                        return False
+                if not results.items:
+                    logger.info(f"No items found on page {index}.")
+                    return True
+                await ingest_page(session, index, results, semaphore, checkpoint)
+                return True
+
+        outcomes = await asyncio.gather(*(process_page(index) for index in pending_pages))
+
+    await asyncio.to_thread(checkpoint.close)
+    await asyncio.to_thread(api_cache.close)
+    if not all(outcomes):
+        logger.critical("One or more pages could not be fetched. Re-run to resume from the checkpoint.")
+        sys.exit(1)
+    logger.info("Database population completed successfully.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
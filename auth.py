@@ -20,4 +20,5 @@ if not url or not key:
     exit(1)
 
 BASE_URL = url
+API_KEY = key
 supabase = create_client(url, key)
@@ -1,11 +1,15 @@
 import logging
 import sys
 import time
-from typing import Optional
+from typing import Iterable, Optional, Set
 
 from supabase import Client
 
+from api_cache import ApiCache, item_key, listing_version, search_key
 from auth import supabase  # Ensure auth.py is in the same directory
+from checkpoint import CrawlCheckpoint
+from lookups import load_table
+from network import RetryPolicy, call_with_retry, heritage_api_limiter, supabase_limiter
 from kheritageapi.heritage import HeritageSearcher, HeritageInfo
 from kheritageapi.models import HeritagSearchResultItem, HeritageDetail, HeritageVideoSet, HeritageImageSet
 
@@ -34,18 +38,37 @@ invalid_logger.addHandler(invalid_file_handler)
 # Constants
 RESULT_COUNT = 100  # Number of items per page; adjust based on API capabilities
 MAX_RETRIES = 5  # Max retries for API requests
-
-
-def heritage_item_exists(uid: str, supabase_client: Client) -> bool:
-    """Check if a heritage item with the given UID already exists in the database."""
+PRELOAD_EXISTING_UIDS = False  # Load every stored uid once at startup instead of one query per page
+CHECKPOINT_PATH = "crawl_checkpoint.sqlite3"  # Completed pages and failed uids, used to resume after a crash
+API_RETRY_POLICY = RetryPolicy(max_retries=MAX_RETRIES, max_delay=16)  # Jittered backoff for API and RPC calls
+API_CACHE_PATH = "api_cache.sqlite3"  # On-disk cache of heritage API responses
+SEARCH_CACHE_TTL = 24 * 3600  # Seconds a cached search page stays valid; item responses follow last_modified
+
+
+def fetch_existing_uids(uids: Iterable[str], supabase_client: Client) -> Set[str]:
+    """Return the subset of the given UIDs that already exist in the database, using a single query."""
+    uids = list(uids)
+    if not uids:
+        return set()
     try:
-        response = supabase_client.table('heritage_items').select('id').eq('uid', uid).execute()
-        exists = len(response.data) > 0
-        logger.debug(f"Heritage item with uid {uid} exists: {exists}")
-        return exists
+        response = call_with_retry(
+            supabase_client.table('heritage_items').select('uid').in_('uid', uids).execute,
+            supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+            description=f"Checking existence of {len(uids)} heritage_items")
+        existing = {row['uid'] for row in response.data}
+        logger.debug(f"{len(existing)} of {len(uids)} heritage items already exist")
+        return existing
     except Exception as e:
-        logger.error(f"Error checking existence of heritage_item with uid {uid}: {e}")
-        return False  # Assume it doesn't exist to prevent skipping
+        logger.error(f"Error checking existence of {len(uids)} heritage_items: {e}")
+        return set()  # Assume none exist to prevent skipping
+
+
+def load_existing_uids(supabase_client: Client) -> Set[str]:
+    """Load every UID stored in heritage_items into memory."""
+    rows = load_table(supabase_client, 'heritage_items', 'uid', key='uid', retry_policy=API_RETRY_POLICY)
+    existing = {row['uid'] for row in rows}
+    logger.info(f"Loaded {len(existing)} existing heritage item uids")
+    return existing
 
 
 def extract_district_code(detail: HeritageDetail) -> Optional[str]:
@@ -139,7 +162,7 @@ def call_insert_stored_procedure(detail: HeritageDetail, images: HeritageImageSe
             logger.debug(f"Formatted registered_date: '{registered_date}'")
 
         # Call the stored procedure
-        supabase_client.rpc(
+        rpc_request = supabase_client.rpc(
             'insert_heritage_item_with_relations',
             {
                 'p_uid': detail.uid,
@@ -170,7 +193,19 @@ def call_insert_stored_procedure(detail: HeritageDetail, images: HeritageImageSe
                 'p_images': images_data if images_data else None,
                 'p_videos': videos_data if videos_data else None
             }
-        ).execute()
+        )
+        response = call_with_retry(rpc_request.execute, supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+                                   description=f"Inserting heritage_item with uid {detail.uid}")
+
+        # The procedure reports codes it could not resolve in its result row instead of notices
+        result = response.data[0] if isinstance(response.data, list) and response.data else response.data
+        if result and result.get('unresolved'):
+            invalid_logger.warning(
+                f"Unresolved codes for heritage_item with uid {detail.uid}: {', '.join(result['unresolved'])}")
+        if result and result.get('status') == 'rejected':
+            logger.error(f"heritage_item with uid {detail.uid} was rejected: unresolved {result.get('unresolved')}")
+            invalid_logger.warning(f"Invalid data for heritage_item with uid {detail.uid}: {detail.__dict__}")
+            return False
 
         logger.info(f"Successfully inserted heritage_item with uid {detail.uid}")
         return True
@@ -183,26 +218,33 @@ def call_insert_stored_procedure(detail: HeritageDetail, images: HeritageImageSe
 
 
 def main():
-    page_index = 1
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH, 'checker')
+    api_cache = ApiCache(API_CACHE_PATH)
+    page_index = checkpoint.next_pending_page(1)
     total_pages = None
+    if page_index > 1:
+        logger.info(f"Resuming from checkpoint at page {page_index}")
+
+    known_uids: Optional[Set[str]] = None
+    if PRELOAD_EXISTING_UIDS:
+        try:
+            known_uids = load_existing_uids(supabase)
+        except Exception as e:
+            logger.error(f"Error preloading existing uids: {e}. Falling back to one query per page.")
 
     while True:
         logger.info(f"Starting page {page_index}")
 
         # Initialize HeritageSearcher
         search = HeritageSearcher(result_count=RESULT_COUNT, page_index=page_index)
-        retries = 0
-        success = False
-        while retries < MAX_RETRIES and not success:
-            try:
-                results: HeritagSearchResultItem = search.perform_search()
-                success = True
-            except Exception as e:
-                retries += 1
-                logger.error(f"Error fetching page {page_index}: {e}. Retry {retries}/{MAX_RETRIES}")
-                time.sleep(2 ** retries)  # Exponential backoff
-
-        if not success:
+        try:
+            results: HeritagSearchResultItem = api_cache.get_or_fetch(
+                search_key(RESULT_COUNT, page_index),
+                lambda: call_with_retry(search.perform_search, heritage_api_limiter, API_RETRY_POLICY,
+                                        description=f"Fetching page {page_index}"),
+                ttl=SEARCH_CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Error fetching page {page_index}: {e}")
             logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries. Exiting.")
             sys.exit(1)
 
@@ -218,22 +260,46 @@ def main():
             total_pages = (total_items // RESULT_COUNT) + (1 if total_items % RESULT_COUNT > 0 else 0)
             logger.info(f"Total items: {total_items}, Total pages: {total_pages}")
 
+            # Page boundaries shift when the result count changes, so old progress no longer applies
+            if checkpoint.hits is not None and checkpoint.hits != total_items:
+                logger.warning(f"Total items changed from {checkpoint.hits} to {total_items}. "
+                               f"Discarding checkpoint and starting from page 1.")
+                checkpoint.reset()
+                checkpoint.set_hits(total_items)
+                if page_index != 1:
+                    page_index = 1
+                    continue
+            checkpoint.set_hits(total_items)
+
         if not results.items:
             logger.info(f"No items found on page {page_index}. Ending pagination.")
             break
 
-        for result in results.items:
+        # Drop items that are already stored before any detail request is made
+        if known_uids is not None:
+            existing_uids = {result.uid for result in results.items if result.uid in known_uids}
+        else:
+            existing_uids = fetch_existing_uids((result.uid for result in results.items), supabase)
+        pending = [result for result in results.items if result.uid not in existing_uids]
+        logger.info(f"Page {page_index}: {len(existing_uids)} items already exist, {len(pending)} to insert")
+
+        # Previously failed uids are retried here too, since they are still missing from the database
+        for result in pending:
             try:
                 uid = result.uid
-                if heritage_item_exists(uid, supabase):
-                    logger.info(f"Heritage item with uid {uid} already exists. Skipping.")
-                    continue
 
                 # Retrieve detailed information
                 item = HeritageInfo(result)
-                detail: HeritageDetail = item.retrieve_detail()
-                images: HeritageImageSet = item.retrieve_image()
-                videos: HeritageVideoSet = item.retrieve_video()
+                version = listing_version(result)
+                detail: HeritageDetail = api_cache.get_or_fetch(item_key('detail', uid), lambda: call_with_retry(
+                    item.retrieve_detail, heritage_api_limiter, API_RETRY_POLICY,
+                    description=f"Retrieving detail for uid {uid}"), version)
+                images: HeritageImageSet = api_cache.get_or_fetch(item_key('image', uid), lambda: call_with_retry(
+                    item.retrieve_image, heritage_api_limiter, API_RETRY_POLICY,
+                    description=f"Retrieving images for uid {uid}"), version)
+                videos: HeritageVideoSet = api_cache.get_or_fetch(item_key('video', uid), lambda: call_with_retry(
+                    item.retrieve_video, heritage_api_limiter, API_RETRY_POLICY,
+                    description=f"Retrieving videos for uid {uid}"), version)
 
                 # Insert into the database using the stored procedure
                 insertion_success = call_insert_stored_procedure(detail, images, videos, supabase)
@@ -241,23 +307,34 @@ def main():
                     # Log the failure and continue with the next item
                     logger.warning(
                         f"Insertion failed for heritage_item with uid {uid}. Logged invalid data and continuing.")
+                    checkpoint.record_failure(uid, page_index, "insertion failed")
                     continue  # Continue with the next item instead of exiting
+                checkpoint.clear_failure(uid)
+                if known_uids is not None:
+                    known_uids.add(uid)
 
             except Exception as e:
                 logger.exception(f"Exception occurred while processing heritage_item with uid {result.uid}: {e}")
                 # Log invalid data to invalid_data.log
                 invalid_logger.warning(
                     f"Exception data for uid {result.uid}: {result.__dict__ if hasattr(result, '__dict__') else str(result)}")
+                checkpoint.record_failure(result.uid, page_index, str(e))
                 # Continue with the next item instead of exiting
                 continue
 
+        # Items that turned out to exist already no longer need a retry
+        checkpoint.clear_failures(existing_uids)
+        checkpoint.mark_page_completed(page_index)
+
         logger.info(f"Completed page {page_index}")
-        page_index += 1
+        page_index = checkpoint.next_pending_page(page_index + 1)
 
         if page_index > total_pages:
             logger.info("All pages processed.")
             break
 
+    checkpoint.close()
+    api_cache.close()
     logger.info("Database population completed successfully.")
 
 
@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger('main_logger')
+
+
+class CrawlCheckpoint:
+    """
+    Durable record of crawl progress stored in a local SQLite file.
+    Tracks completed pages, uids that failed and the last seen `results.hits`
+    so that a crawl can resume where it stopped after a crash.
+    Several crawls (e.g. 'init' and 'checker') can share one file.
+    """
+
+    def __init__(self, path: str, crawl: str):
+        self.crawl = crawl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS completed_pages (
+                crawl        TEXT    NOT NULL,
+                page_index   INTEGER NOT NULL,
+                completed_at REAL    NOT NULL,
+                PRIMARY KEY (crawl, page_index)
+            );
+            CREATE TABLE IF NOT EXISTS failed_uids (
+                crawl      TEXT    NOT NULL,
+                uid        TEXT    NOT NULL,
+                page_index INTEGER NOT NULL,
+                reason     TEXT,
+                failed_at  REAL    NOT NULL,
+                PRIMARY KEY (crawl, uid)
+            );
+            CREATE TABLE IF NOT EXISTS crawl_state (
+                crawl TEXT PRIMARY KEY,
+                hits  INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS checked_versions (
+                crawl   TEXT NOT NULL,
+                uid     TEXT NOT NULL,
+                version TEXT NOT NULL,
+                PRIMARY KEY (crawl, uid)
+            );
+        """)
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor.fetchall()
+
+    @property
+    def hits(self) -> Optional[int]:
+        """The total number of search results recorded by the previous run."""
+        rows = self._execute("SELECT hits FROM crawl_state WHERE crawl = ?", (self.crawl,))
+        return rows[0][0] if rows else None
+
+    def set_hits(self, hits: int) -> None:
+        self._execute(
+            "INSERT INTO crawl_state (crawl, hits) VALUES (?, ?) "
+            "ON CONFLICT (crawl) DO UPDATE SET hits = excluded.hits",
+            (self.crawl, hits))
+
+    def completed_pages(self) -> Set[int]:
+        rows = self._execute("SELECT page_index FROM completed_pages WHERE crawl = ?", (self.crawl,))
+        return {row[0] for row in rows}
+
+    def mark_page_completed(self, page_index: int) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO completed_pages (crawl, page_index, completed_at) VALUES (?, ?, ?)",
+            (self.crawl, page_index, time.time()))
+
+    def failed_uids(self, page_index: Optional[int] = None) -> Set[str]:
+        """Return the uids that are still failing, optionally only those of one page."""
+        if page_index is None:
+            rows = self._execute("SELECT uid FROM failed_uids WHERE crawl = ?", (self.crawl,))
+        else:
+            rows = self._execute(
+                "SELECT uid FROM failed_uids WHERE crawl = ? AND page_index = ?", (self.crawl, page_index))
+        return {row[0] for row in rows}
+
+    def record_failure(self, uid: str, page_index: int, reason: Optional[str] = None) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO failed_uids (crawl, uid, page_index, reason, failed_at) VALUES (?, ?, ?, ?, ?)",
+            (self.crawl, uid, page_index, reason, time.time()))
+
+    def clear_failure(self, uid: str) -> None:
+        self._execute("DELETE FROM failed_uids WHERE crawl = ? AND uid = ?", (self.crawl, uid))
+
+    def clear_failures(self, uids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM failed_uids WHERE crawl = ? AND uid = ?", [(self.crawl, uid) for uid in uids])
+            self._conn.commit()
+
+    def checked_versions(self) -> Dict[str, str]:
+        """Return the listing version at which each uid was last re-checked."""
+        rows = self._execute("SELECT uid, version FROM checked_versions WHERE crawl = ?", (self.crawl,))
+        return {uid: version for uid, version in rows}
+
+    def mark_checked(self, versions: Dict[str, str]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO checked_versions (crawl, uid, version) VALUES (?, ?, ?)",
+                [(self.crawl, uid, version) for uid, version in versions.items()])
+            self._conn.commit()
+
+    def next_pending_page(self, page_index: int) -> int:
+        """
+        Return the first page at or after page_index that still needs work:
+        either it was never completed or it has uids left to retry.
+        """
+        completed = self.completed_pages()
+        retry_pages = {row[0] for row in self._execute(
+            "SELECT DISTINCT page_index FROM failed_uids WHERE crawl = ?", (self.crawl,))}
+        while page_index in completed and page_index not in retry_pages:
+            page_index += 1
+        return page_index
+
+    def resume(self, total_items: int, page_size: int) -> List[int]:
+        """
+        Record the total number of search results of this run and return the pages that
+        still need work, in order. Page boundaries shift when the total changes, so the
+        progress of the previous run is discarded in that case.
+        """
+        previous = self.hits
+        if previous is not None and previous != total_items:
+            logger.warning(f"Total items changed from {previous} to {total_items}. "
+                           f"Discarding checkpoint and starting from page 1.")
+            self.reset()
+        self.set_hits(total_items)
+
+        total_pages = (total_items // page_size) + (1 if total_items % page_size > 0 else 0)
+        completed = self.completed_pages()
+        retry_pages = {row[0] for row in self._execute(
+            "SELECT DISTINCT page_index FROM failed_uids WHERE crawl = ?", (self.crawl,))}
+        return [page_index for page_index in range(1, total_pages + 1)
+                if page_index not in completed or page_index in retry_pages]
+
+    def reset(self) -> None:
+        """Forget all progress of this crawl."""
+        with self._lock:
+            for table in ('completed_pages', 'failed_uids', 'crawl_state'):
+                self._conn.execute(f"DELETE FROM {table} WHERE crawl = ?", (self.crawl,))
+            self._conn.commit()
+        logger.info(f"Checkpoint for crawl '{self.crawl}' reset")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,167 @@
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import psycopg
+from tqdm import tqdm  # For progress bar
+
+from auth import config
+from checkpoint import CrawlCheckpoint
+from init import (logger, invalid_logger, api_cache, prefetch_pages, resume_crawl, retrieve_heritage_record,
+                  RESULT_COUNT, MAX_WORKERS, MAX_RETRIES, PREFETCH_PAGES, CHECKPOINT_PATH)
+
+# Offline loader for first-time population. Instead of going through PostgREST, it
+# connects to Postgres directly, streams every page into the staging tables of
+# SQL/set_up_copy_loader.sql with COPY and merges them into heritage_items, images
+# and videos with one set-based statement at the end, with the secondary indexes
+# dropped during the merge and rebuilt once afterwards.
+
+# Constants
+DATABASE_URL = os.getenv("DATABASE_URL") or config.get("DATABASE_URL")  # Direct Postgres connection string
+DEFER_INDEXES = True  # Drop secondary indexes before the merge and rebuild them afterwards
+MERGE_WORK_MEM = "256MB"  # work_mem for the merge; its joins and DISTINCT ON sort the whole staging set
+INDEX_BUILD_MEM = "1GB"  # maintenance_work_mem for the index rebuilds
+
+STAGING_TABLES = ('staging_heritage_items', 'staging_images', 'staging_videos')
+ITEM_COLUMNS = (
+    'uid', 'name', 'name_hanja', 'city_code', 'district_code', 'heritage_type_code',
+    'canceled', 'last_modified', 'management_number', 'linkage_number',
+    'longitude', 'latitude', 'type', 'quantity', 'registered_date',
+    'location_description', 'era', 'owner', 'manager', 'thumbnail', 'content',
+    'category1_name', 'category2_name', 'category3_name', 'category4_name'
+)
+
+
+def copy_records(conn: psycopg.Connection, records: List[dict]) -> None:
+    """
+    Stream the records of one page and their images and videos into the staging tables.
+    Rows already staged for the same uids (a page restaged after a crash) are replaced.
+    """
+    uids = [record['uid'] for record in records]
+    with conn.transaction(), conn.cursor() as cur:
+        for table in STAGING_TABLES:
+            cur.execute(f"DELETE FROM {table} WHERE uid = ANY(%s)", (uids,))
+        with cur.copy(f"COPY staging_heritage_items ({', '.join(ITEM_COLUMNS)}) FROM STDIN") as copy:
+            for record in records:
+                copy.write_row(tuple(record[column] for column in ITEM_COLUMNS))
+        with cur.copy("COPY staging_images (uid, image_license, image_url, description) FROM STDIN") as copy:
+            for record in records:
+                for image in record['images'] or ():
+                    copy.write_row((record['uid'], image['licence'], image['image_url'], image['description']))
+        with cur.copy("COPY staging_videos (uid, video_url) FROM STDIN") as copy:
+            for record in records:
+                for video in record['videos'] or ():
+                    copy.write_row((record['uid'], video['video_url']))
+
+
+def stage_page(conn: psycopg.Connection, page_index: int, items, executor: ThreadPoolExecutor,
+               checkpoint: CrawlCheckpoint, pbar: tqdm) -> None:
+    """Retrieve every item of a page and COPY the page into staging in one transaction."""
+    records, failed_uids = [], set()
+    for result, record in zip(items, executor.map(retrieve_heritage_record, items)):
+        pbar.update(1)
+        if record is None:
+            failed_uids.add(result.uid)
+        else:
+            records.append(record)
+
+    try:
+        copy_records(conn, records)
+    except Exception as e:
+        logger.error(f"Error staging page {page_index}: {e}")
+        failed_uids.update(record['uid'] for record in records)
+
+    if failed_uids:
+        logger.critical(f"Staging failed for {len(failed_uids)} heritage_items on page {page_index}.")
+    for uid in failed_uids:
+        checkpoint.record_failure(uid, page_index)
+    checkpoint.clear_failures(result.uid for result in items if result.uid not in failed_uids)
+    checkpoint.mark_page_completed(page_index)
+    logger.info(f"Staged page {page_index}")
+
+
+def merge_staging(conn: psycopg.Connection) -> None:
+    """Merge the staged rows into the real tables, with index builds deferred until after the merge."""
+    with conn.cursor() as cur:
+        with conn.transaction():
+            cur.execute(f"SET LOCAL work_mem = '{MERGE_WORK_MEM}'")
+            if DEFER_INDEXES:
+                deferred = cur.execute("SELECT defer_secondary_indexes()").fetchone()[0]
+                logger.info(f"Deferred {deferred} secondary indexes")
+            inserted = cur.execute("SELECT merge_staged_heritage_items()").fetchone()[0]
+            logger.info(f"Merged {inserted} new heritage_items")
+            rejected = cur.execute("SELECT uid, unresolved FROM staging_rejected_items ORDER BY uid").fetchall()
+            for uid, unresolved in rejected:
+                invalid_logger.warning(f"Unresolved codes for heritage_item with uid {uid}: {', '.join(unresolved)}")
+            if rejected:
+                logger.error(f"{len(rejected)} staged heritage_items were rejected; see staging_rejected_items.")
+        if DEFER_INDEXES:
+            with conn.transaction():
+                cur.execute(f"SET LOCAL maintenance_work_mem = '{INDEX_BUILD_MEM}'")
+                restored = cur.execute("SELECT restore_secondary_indexes()").fetchone()[0]
+                logger.info(f"Rebuilt {restored} secondary indexes")
+        # VACUUM and ANALYZE refuse to run inside a transaction block
+        conn.autocommit = True
+        for table in ('heritage_items', 'images', 'videos', 'categories'):
+            cur.execute(f"ANALYZE public.{table}")
+
+
+def main():
+    if not DATABASE_URL:
+        logger.critical("DATABASE_URL is not set in the environment or config.json. Exiting.")
+        sys.exit(1)
+
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH, 'copy_loader')
+    conn = psycopg.connect(DATABASE_URL)
+
+    total_items, pending_pages, results = resume_crawl(checkpoint)
+
+    # Staged rows survive a crash of the loader, so only a fresh run (or one whose checkpoint
+    # resume_crawl discarded because the total changed) starts from empty staging tables
+    if not checkpoint.completed_pages():
+        with conn.transaction():
+            conn.execute(f"TRUNCATE {', '.join(STAGING_TABLES)}, staging_rejected_items")
+
+    page_queue = queue.Queue(maxsize=PREFETCH_PAGES)
+    page_queue.put((pending_pages[0], results) if pending_pages else None)
+    producer = threading.Thread(target=prefetch_pages, args=(pending_pages[1:], page_queue), daemon=True)
+    producer.start()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            tqdm(total=min(total_items, len(pending_pages) * RESULT_COUNT), desc="Staging items",
+                 unit="item") as pbar:
+        while True:
+            entry = page_queue.get()
+            if entry is None:
+                break
+            page_index, results = entry
+            if isinstance(results, Exception):
+                logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries. Exiting.")
+                sys.exit(1)
+            if not results.items:
+                logger.info(f"No items found on page {page_index}. Ending pagination.")
+                break
+
+            items = results.items
+            if page_index in checkpoint.completed_pages():
+                retry_uids = checkpoint.failed_uids(page_index)
+                items = [result for result in items if result.uid in retry_uids]
+                logger.info(f"Retrying {len(items)} failed items on page {page_index}")
+            stage_page(conn, page_index, items, executor, checkpoint, pbar)
+
+    failed = checkpoint.failed_uids()
+    if failed:
+        logger.warning(f"{len(failed)} heritage_items could not be staged; run copy_loader.py again to retry them.")
+
+    merge_staging(conn)
+    conn.close()
+    checkpoint.close()
+    api_cache.close()
+    logger.info("Bulk load completed successfully.")
+
+
+if __name__ == "__main__":
+    main()
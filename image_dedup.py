@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import logging
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+from supabase import Client
+
+from image_header import MAX_IMAGE_PIXELS
+from lookups import load_table
+from network import RetryPolicy, call_with_retry, supabase_limiter
+
+# Constants
+DHASH_SIZE = 8  # dHash grid; 8 gives a 64-bit hash
+DHASH_MAX_DISTANCE = 4  # Hamming distance up to which two sources count as the same photo
+ASPECT_TOLERANCE = 0.02  # Relative aspect ratio difference allowed for a perceptual match
+LOAD_RETRY_POLICY = RetryPolicy(max_retries=3)  # Backoff for index queries
+
+
+def content_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def compute_dhash(image_bytes: bytes) -> Optional[Tuple[int, int, int]]:
+    """
+    Computes the difference hash of an image: it is shrunk to a (DHASH_SIZE + 1) x DHASH_SIZE
+    greyscale grid and every bit says whether a pixel is brighter than its right neighbour.
+    Returns (dhash, width, height) with the original dimensions, or None on failure.
+    """
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            width, height = img.size
+            if width * height > MAX_IMAGE_PIXELS:
+                raise Image.DecompressionBombError(f"{width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels")
+            if img.format == "JPEG":
+                img.draft("L", (DHASH_SIZE * 8, DHASH_SIZE * 8))
+            pixels = list(img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.LANCZOS).getdata())
+        dhash = 0
+        for row in range(DHASH_SIZE):
+            for col in range(DHASH_SIZE):
+                left = pixels[row * (DHASH_SIZE + 1) + col]
+                right = pixels[row * (DHASH_SIZE + 1) + col + 1]
+                dhash = (dhash << 1) | (left > right)
+        return dhash, width, height
+    except Exception as e:
+        logging.error(f"Error hashing image: {e}")
+        return None
+
+
+def to_signed(dhash: int) -> int:
+    """Maps an unsigned 64-bit hash onto the BIGINT range."""
+    return dhash - (1 << 64) if dhash >= (1 << 63) else dhash
+
+
+def to_unsigned(dhash: int) -> int:
+    return dhash & ((1 << 64) - 1)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class SourceIndex:
+    """
+    Index of the source images that were already optimized, by SHA-256 of the
+    downloaded bytes and by dHash. A thumbnail whose source matches an entry
+    reuses that entry's optimized URL and variants instead of being encoded
+    and uploaded again. Exact duplicates that are processed concurrently wait
+    for the first one instead of racing it.
+    """
+
+    def __init__(self, max_distance: int = DHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._by_hash: Dict[str, dict] = {}
+        self._entries: List[dict] = []
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def load(self, client: Client) -> None:
+        """Loads the fingerprints of every optimized thumbnail."""
+        rows = load_table(client, 'thumbnail',
+                          'id, content_hash, dhash, optimized_url, optimized_width, optimized_height',
+                          where=lambda query: query.not_.is_('content_hash', None).not_.is_('optimized_url', None),
+                          retry_policy=LOAD_RETRY_POLICY)
+        for row in rows:
+            self.add({
+                'thumbnail_id': row['id'],
+                'content_hash': row['content_hash'],
+                'dhash': to_unsigned(row['dhash']) if row['dhash'] is not None else None,
+                'fields': {
+                    'optimized_url': row['optimized_url'],
+                    'optimized_width': row['optimized_width'],
+                    'optimized_height': row['optimized_height'],
+                },
+                'variants': None,  # Loaded from thumbnail_variants on the first match
+            })
+        logging.info(f"Loaded {len(self._entries)} source fingerprints.")
+
+    def add(self, entry: dict) -> None:
+        self._by_hash.setdefault(entry['content_hash'], entry)
+        if entry['dhash'] is not None:
+            self._entries.append(entry)
+
+    def find_exact(self, source_hash: str) -> Optional[dict]:
+        return self._by_hash.get(source_hash)
+
+    def find_similar(self, dhash: int, width: int, height: int) -> Optional[dict]:
+        """Returns the closest entry within max_distance whose aspect ratio matches, if any."""
+        aspect = width / height
+        best, best_distance = None, self.max_distance + 1
+        for entry in self._entries:
+            distance = hamming_distance(dhash, entry['dhash'])
+            if distance >= best_distance:
+                continue
+            fields = entry['fields']
+            if not fields['optimized_width'] or not fields['optimized_height']:
+                continue
+            if abs(fields['optimized_width'] / fields['optimized_height'] - aspect) > ASPECT_TOLERANCE * aspect:
+                continue
+            best, best_distance = entry, distance
+        return best
+
+    async def wait_pending(self, source_hash: str) -> None:
+        """Waits until no task is optimizing a source with the same content hash."""
+        while True:
+            future = self._pending.get(source_hash)
+            if future is None:
+                return
+            await asyncio.shield(future)
+
+    def begin(self, source_hash: str) -> bool:
+        """
+        Claims a content hash for the calling task. Returns False if another task holds it;
+        call it right after wait_pending() and find_exact(), without awaiting in between.
+        """
+        if source_hash in self._pending:
+            return False
+        self._pending[source_hash] = asyncio.get_running_loop().create_future()
+        return True
+
+    def finish(self, source_hash: str, entry: Optional[dict] = None) -> None:
+        """Publishes the result of an optimization started with begin(); None means it failed."""
+        if entry is not None:
+            self.add(entry)
+        future = self._pending.pop(source_hash, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def variants_of(self, entry: dict, client: Client) -> List[dict]:
+        """Returns the variant rows of an entry, reading them from thumbnail_variants if needed."""
+        if entry['variants'] is None:
+            query = client.table('thumbnail_variants') \
+                .select('width, height, format, url, byte_size') \
+                .eq('thumbnail_id', entry['thumbnail_id'])
+            response = await asyncio.to_thread(
+                call_with_retry, query.execute, supabase_limiter, LOAD_RETRY_POLICY, False,
+                f"Loading variants of Thumbnail ID {entry['thumbnail_id']}")
+            entry['variants'] = response.data
+        return entry['variants']
@@ -1,8 +1,14 @@
 import asyncio
+import os
 import aiohttp
 from PIL import Image
 from io import BytesIO
 from auth import supabase
+from image_header import probe_dimensions
+from network import (NOT_MODIFIED, ByteBudget, HTTPStatusError, RetryPolicy, async_call_with_retry,
+                     conditional_headers, image_host_limiter, raise_for_status, read_limited, response_validators,
+                     supabase_limiter)
+from thumbnail_writer import ThumbnailUpdateBuffer
 import logging
 
 # Configure logging
@@ -17,25 +23,77 @@ logging.basicConfig(
 
 # Constants for pagination
 PAGE_SIZE = 50  # Maximum number of records per page
+IMAGE_RETRY_POLICY = RetryPolicy(max_retries=3, max_delay=16)  # Backoff for image downloads
+DB_RETRY_POLICY = RetryPolicy(max_retries=3)  # Backoff for Supabase queries
+PROBE_HEADERS = True  # Read dimensions from the first bytes of the image instead of downloading all of it
+PROBE_CHUNK_SIZE = 4096  # Bytes requested per read while probing
+PROBE_MAX_BYTES = 64 * 1024  # Give up probing (and download the whole image) after this many bytes
+REFRESH = os.getenv("THUMBNAIL_REFRESH") == "1"  # Revalidate measured thumbnails instead of working the pending queue
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 20 * 1024 ** 2))  # Larger images are rejected on full download
+MAX_IN_FLIGHT_BYTES = int(os.getenv("MAX_IN_FLIGHT_BYTES", 128 * 1024 ** 2))  # Image bytes held by all tasks at once
 
+download_budget = ByteBudget(MAX_IN_FLIGHT_BYTES)
 
-async def fetch_image(session, url):
+
+async def fetch_image(session, url, headers=None):
     """
     Fetches the image from the given URL asynchronously.
-    Returns the image bytes if successful, else None.
+    Retries throttling, server errors and connection failures with jittered backoff.
+    The body is streamed under MAX_IMAGE_BYTES and stays reserved in download_budget
+    until the caller releases it.
+    Returns (image bytes, validators) if successful, NOT_MODIFIED if a conditional
+    request was answered with 304, else None.
     """
+    async def attempt():
+        async with session.get(url, headers=headers, timeout=10) as response:
+            if response.status == 304:
+                return NOT_MODIFIED
+            raise_for_status(response)
+            return await read_limited(response, MAX_IMAGE_BYTES, download_budget), response_validators(response)
+
     try:
-        async with session.get(url, timeout=10) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                logging.warning(f"Failed to fetch {url}: Status {response.status}")
-                return None
+        return await async_call_with_retry(attempt, image_host_limiter, IMAGE_RETRY_POLICY,
+                                           description=f"Fetching {url}")
+    except HTTPStatusError as e:
+        logging.warning(f"Failed to fetch {url}: Status {e.status}")
+        return None
     except Exception as e:
         logging.error(f"Error fetching {url}: {e}")
         return None
 
 
+async def probe_image(session, url, headers=None):
+    """
+    Reads only the first bytes of the image (using an HTTP Range request where the
+    server supports it) and parses the dimensions from the JPEG/PNG/GIF/WebP header.
+    Returns ((width, height), validators) with None dimensions if the header was
+    inconclusive, NOT_MODIFIED if a conditional request was answered with 304, or
+    None if the request failed.
+    """
+    async def attempt():
+        request_headers = {**(headers or {}), 'Range': f'bytes=0-{PROBE_MAX_BYTES - 1}'}
+        async with session.get(url, headers=request_headers, timeout=10) as response:
+            if response.status == 304:
+                return NOT_MODIFIED
+            raise_for_status(response)
+            validators = response_validators(response)
+            data = b''
+            # Servers that ignore Range send the whole file; stop reading as soon as the header is parsed
+            async for chunk in response.content.iter_chunked(PROBE_CHUNK_SIZE):
+                data += chunk
+                dimensions = probe_dimensions(data)
+                if dimensions is not None or len(data) >= PROBE_MAX_BYTES:
+                    return dimensions, validators
+            return probe_dimensions(data), validators
+
+    try:
+        return await async_call_with_retry(attempt, image_host_limiter, IMAGE_RETRY_POLICY,
+                                           description=f"Probing {url}")
+    except Exception as e:
+        logging.warning(f"Probing {url} failed: {e}. Falling back to a full download.")
+        return None
+
+
 def get_image_dimensions(image_bytes):
     """
     Returns the width and height of the image.
@@ -48,51 +106,75 @@ def get_image_dimensions(image_bytes):
         return None, None
 
 
-async def process_thumbnail(session, thumbnail):
+async def process_thumbnail(session, thumbnail, writer):
     """
     Processes a single thumbnail: fetches the image, gets dimensions,
-    and updates the database.
+    and queues the database update in the write-behind buffer.
+    In refresh mode the request is conditional and unchanged images are skipped.
     """
     thumbnail_id = thumbnail['id']
     url = thumbnail['url']
     logging.info(f"Processing Thumbnail ID: {thumbnail_id}, URL: {url}")
 
-    image_bytes = await fetch_image(session, url)
-    if image_bytes is None:
-        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to fetch failure.")
+    headers = conditional_headers(thumbnail['source_etag'], thumbnail['source_last_modified']) if REFRESH else None
+    probed = await probe_image(session, url, headers) if PROBE_HEADERS else None
+    if probed is NOT_MODIFIED:
+        logging.info(f"Thumbnail ID: {thumbnail_id} is unchanged. Skipping.")
         return
-
-    width, height = get_image_dimensions(image_bytes)
+    if probed is not None and probed[0] is not None:
+        (width, height), validators = probed
+    else:
+        fetched = await fetch_image(session, url, headers)
+        if fetched is NOT_MODIFIED:
+            logging.info(f"Thumbnail ID: {thumbnail_id} is unchanged. Skipping.")
+            return
+        if fetched is None:
+            logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to fetch failure.")
+            return
+
+        image_bytes, validators = fetched
+        validators['content_length'] = validators['content_length'] or len(image_bytes)
+        width, height = get_image_dimensions(image_bytes)
+        download_budget.release(len(image_bytes))
     if width is None or height is None:
         logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to processing failure.")
         return
 
-    # Update the thumbnail record in Supabase
-    try:
-        supabase.table('thumbnail').update({
-            'width': width,
-            'height': height,
-        }).eq('id', thumbnail_id).execute()
-        logging.info(f"Updated Thumbnail ID: {thumbnail_id} with width: {width}, height: {height}")
-    except Exception as e:
-        logging.error(f"Error updating Thumbnail ID: {thumbnail_id}: {e}")
+    # Queue the update; the buffer writes it together with the rest of its batch
+    await writer.add(thumbnail_id, {
+        'width': width,
+        'height': height,
+        'source_etag': validators['etag'],
+        'source_last_modified': validators['last_modified'],
+        'source_content_length': validators['content_length'],
+    })
+    logging.info(f"Queued update for Thumbnail ID: {thumbnail_id} with width: {width}, height: {height}")
 
 
-async def fetch_thumbnails(offset):
+async def fetch_thumbnails(last_id):
     """
-    Fetches a single page of thumbnails where width or height is NULL.
+    Fetches the next page of thumbnails where width or height is NULL, in id order.
+    In refresh mode it fetches measured thumbnails with stored validators instead.
+    Keyset pagination (id > last_id) keeps every pass complete even though processed
+    rows drop out of the filter, and each page costs the same however deep the pass is.
     """
     try:
-        response = supabase.table('thumbnail') \
-            .select('id, url') \
-            .is_('width', None) \
-            .is_('height', None) \
-            .range(offset, offset + PAGE_SIZE - 1) \
-            .execute()
+        query = supabase.table('thumbnail').select('id, url, source_etag, source_last_modified')
+        if REFRESH:
+            query = query.not_.is_('width', None) \
+                .or_('source_etag.not.is.null,source_last_modified.not.is.null')
+        else:
+            query = query.is_('width', None).is_('height', None)
+        query = query.order('id').limit(PAGE_SIZE)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        response = await async_call_with_retry(lambda: asyncio.to_thread(query.execute), supabase_limiter,
+                                               DB_RETRY_POLICY, retry_unknown=False,
+                                               description=f"Fetching thumbnails after id {last_id}")
 
         return response.data  # Returns a list of thumbnails
     except Exception as e:
-        logging.error(f"Error fetching thumbnails for offset {offset}: {e}")
+        logging.error(f"Error fetching thumbnails after id {last_id}: {e}")
         return []
 
 
@@ -100,24 +182,24 @@ async def main():
     """
     Main asynchronous function to process all thumbnails with pagination.
     """
-    offset = 0
+    last_id = None
     total_processed = 0
 
-    # Use a session for all HTTP requests
-    async with aiohttp.ClientSession() as session:
+    # Use a session for all HTTP requests and one buffer for all database updates
+    async with aiohttp.ClientSession() as session, ThumbnailUpdateBuffer(supabase) as writer:
         while True:
-            thumbnails = await fetch_thumbnails(offset)
+            thumbnails = await fetch_thumbnails(last_id)
             if not thumbnails:
-                if offset == 0:
+                if last_id is None:
                     logging.info("No thumbnails to process. Exiting.")
                 else:
-                    logging.info(f"All thumbnails processed up to offset {offset - PAGE_SIZE}. Exiting.")
+                    logging.info(f"All thumbnails processed up to id {last_id}. Exiting.")
                 break
 
-            logging.info(f"Processing Thumbnails with offset {offset}: {len(thumbnails)} thumbnails.")
+            logging.info(f"Processing Thumbnails after id {last_id}: {len(thumbnails)} thumbnails.")
 
             # Create a list of tasks for concurrent processing
-            tasks = [process_thumbnail(session, thumbnail) for thumbnail in thumbnails]
+            tasks = [process_thumbnail(session, thumbnail, writer) for thumbnail in thumbnails]
 
             # Limit the number of concurrent tasks to avoid overwhelming the server
             semaphore = asyncio.Semaphore(10)
@@ -133,9 +215,8 @@ async def main():
             await asyncio.gather(*sem_tasks)
 
             total_processed += len(thumbnails)
-            logging.info(f"Completed processing offset {offset}. Total thumbnails processed: {total_processed}")
-
-            offset += PAGE_SIZE  # Move to the next page
+            last_id = thumbnails[-1]['id']  # Move to the next page
+            logging.info(f"Completed processing up to id {last_id}. Total thumbnails processed: {total_processed}")
 
     logging.info("Thumbnail processing completed.")
 
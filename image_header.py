@@ -0,0 +1,64 @@
+import struct
+from typing import Optional, Tuple
+
+MAX_IMAGE_PIXELS = 50_000_000  # Decompression-bomb guard: images with more pixels are never decoded
+
+# JPEG start-of-frame markers carry the image size; DHT (C4), JPG (C8) and DAC (CC) share the range but do not
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def _jpeg_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None  # Not positioned on a marker; the stream is corrupt
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # Fill byte
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            return None  # End of image or start of scan before any frame header
+        (length,) = struct.unpack('>H', data[offset + 2:offset + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def _webp_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30 and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25 and data[20] == 0x2F:
+        (bits,) = struct.unpack('<I', data[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def probe_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Read (width, height) from the first bytes of a JPEG, PNG, GIF or WebP file.
+    Returns None when the format is unknown or the header is not complete yet.
+    """
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_dimensions(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24 and data[12:16] == b'IHDR':
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp_dimensions(data)
+    return None
@@ -1,12 +1,19 @@
 import asyncio
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 
 import aiohttp
 from PIL import Image
 
-from auth import supabase, BASE_URL
+from auth import supabase, BASE_URL, API_KEY
+from network import (NOT_MODIFIED, ByteBudget, HTTPStatusError, RetryPolicy, async_call_with_retry,
+                     conditional_headers, image_host_limiter, raise_for_status, read_limited, response_validators,
+                     supabase_limiter)
+from image_dedup import SourceIndex, compute_dhash, content_hash, to_signed
+from image_header import MAX_IMAGE_PIXELS, probe_dimensions
+from thumbnail_writer import ThumbnailUpdateBuffer
 
 # Configure logging
 logging.basicConfig(
@@ -19,191 +26,350 @@ logging.basicConfig(
 
 # Constants for pagination
 PAGE_SIZE = 50  # Maximum number of records per page
+IMAGE_RETRY_POLICY = RetryPolicy(max_retries=3, max_delay=16)  # Backoff for image downloads
+DB_RETRY_POLICY = RetryPolicy(max_retries=3)  # Backoff for Supabase queries
 STORAGE_BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET")  # Ensure this is set in your .env file
-
-# Ensure the temp directory exists
-TEMP_DIR = "./temp"
-os.makedirs(TEMP_DIR, exist_ok=True)
-
-
-async def fetch_image(session, url):
+THUMBNAIL_BUCKET = "thumbnail"  # Storage bucket the optimized variants are uploaded to
+UPLOAD_TIMEOUT = 60  # Seconds to wait for a single storage upload
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))  # Processes used for decode/resize/encode
+
+# Responsive variants generated for every thumbnail; widths above the original are capped to it
+VARIANT_WIDTHS = [int(width) for width in os.getenv("THUMBNAIL_VARIANT_WIDTHS", "160,320,640,1280").split(",")]
+VARIANT_FORMATS = os.getenv("THUMBNAIL_VARIANT_FORMATS", "WEBP,AVIF").upper().split(",")  # AVIF needs Pillow 11.2+
+VARIANT_QUALITY = {"WEBP": 80, "AVIF": 60}  # Encoder quality per format
+VARIANT_FILE_TYPES = {"WEBP": ("webp", "image/webp"), "AVIF": ("avif", "image/avif")}  # Extension and content type
+PRIMARY_WIDTH = 640  # thumbnail.optimized_url points at the widest WebP variant not wider than this
+DEDUPLICATE_SOURCES = True  # Reuse the optimized files of an identical or perceptually equal source image
+REFRESH = os.getenv("THUMBNAIL_REFRESH") == "1"  # Revalidate optimized thumbnails instead of working the pending queue
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 20 * 1024 ** 2))  # Larger source images are rejected
+MAX_IN_FLIGHT_BYTES = int(os.getenv("MAX_IN_FLIGHT_BYTES", 256 * 1024 ** 2))  # Source bytes held by all tasks at once
+
+# Pillow refuses to decode images above this many pixels in every process, including the pool workers
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+download_budget = ByteBudget(MAX_IN_FLIGHT_BYTES)
+
+
+async def fetch_image(session, url, headers=None):
     """
     Fetches the image from the given URL asynchronously.
-    Returns the image bytes if successful, else None.
+    Retries throttling, server errors and connection failures with jittered backoff.
+    The body is streamed under MAX_IMAGE_BYTES and stays reserved in download_budget
+    until the caller releases it.
+    Returns (image bytes, validators) if successful, NOT_MODIFIED if a conditional
+    request was answered with 304, else None.
     """
+    async def attempt():
+        async with session.get(url, headers=headers, timeout=20) as response:
+            if response.status == 304:
+                return NOT_MODIFIED
+            raise_for_status(response)
+            return await read_limited(response, MAX_IMAGE_BYTES, download_budget), response_validators(response)
+
     try:
-        async with session.get(url, timeout=20) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                logging.warning(f"Failed to fetch {url}: Status {response.status}")
-                return None
+        return await async_call_with_retry(attempt, image_host_limiter, IMAGE_RETRY_POLICY,
+                                           description=f"Fetching {url}")
+    except HTTPStatusError as e:
+        logging.warning(f"Failed to fetch {url}: Status {e.status}")
+        return None
     except Exception as e:
         logging.error(f"Error fetching {url}: {e}")
         return None
 
 
-def get_image_dimensions(image_bytes):
+def supported_formats(formats):
     """
-    Returns the width and height of the image.
+    Returns the formats this Pillow build can encode, warning about the others.
     """
-    try:
-        with Image.open(BytesIO(image_bytes)) as img:
-            return img.width, img.height
-    except Exception as e:
-        logging.error(f"Error processing image: {e}")
-        return None, None
+    Image.init()
+    supported = [image_format for image_format in formats if image_format in Image.SAVE]
+    for image_format in formats:
+        if image_format not in supported:
+            logging.warning(f"Pillow cannot encode {image_format}. Skipping {image_format} variants.")
+    return supported
 
 
-def resize_image(image_bytes, max_width=640):
+def generate_variants(image_bytes, widths, formats):
     """
-    Resizes the image to the specified max width while maintaining aspect ratio.
-    Returns the resized image bytes in WebP format.
+    Decodes the image once and encodes it at every width and format while maintaining aspect ratio.
+    JPEG sources are decoded straight at a reduced scale with draft(); other formats are
+    shrunk with reduce() before the LANCZOS passes.
+    Returns (original_width, original_height, variants) where each variant is a dict with
+    width, height, format and data, or None on failure.
     """
     try:
         with Image.open(BytesIO(image_bytes)) as img:
-            # Calculate the new height to maintain aspect ratio
-            if img.width > max_width:
-                ratio = max_width / float(img.width)
-                new_height = int(float(img.height) * ratio)
-                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                logging.info(f"Resized image to ({max_width}, {new_height})")
-            else:
-                logging.info(
-                    f"Image width ({img.width}) is less than or equal to max width ({max_width}). Skipping resize.")
-
-            # Convert image to WebP format
-            resized_io = BytesIO()
-            img.save(resized_io, format="WEBP", quality=80, optimize=True)
-            resized_bytes = resized_io.getvalue()
-            return resized_bytes
+            original_width, original_height = img.size
+            if original_width * original_height > MAX_IMAGE_PIXELS:
+                raise Image.DecompressionBombError(
+                    f"{original_width}x{original_height} exceeds {MAX_IMAGE_PIXELS} pixels")
+            targets = sorted({min(width, original_width) for width in widths}, reverse=True)
+            largest = targets[0]
+            if largest < original_width:
+                largest_height = max(1, round(original_height * largest / original_width))
+                if img.format == "JPEG":
+                    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the largest target
+                    img.draft("RGB", (largest, largest_height))
+                else:
+                    factor = original_width // (largest * 2)
+                    if factor > 1:
+                        img = img.reduce(factor)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.mode or "transparency" in img.info else "RGB")
+
+            variants = []
+            for width in targets:
+                height = max(1, round(original_height * width / original_width))
+                resized = img if img.size == (width, height) else img.resize((width, height),
+                                                                             Image.Resampling.LANCZOS)
+                for image_format in formats:
+                    encoded_io = BytesIO()
+                    resized.save(encoded_io, format=image_format, quality=VARIANT_QUALITY.get(image_format, 80))
+                    variants.append({
+                        'width': width,
+                        'height': height,
+                        'format': image_format,
+                        'data': encoded_io.getvalue(),
+                    })
+            logging.info(f"Generated {len(variants)} variants from ({original_width}, {original_height})")
+            return original_width, original_height, variants
     except Exception as e:
-        logging.error(f"Error resizing image: {e}")
+        logging.error(f"Error optimizing image: {e}")
         return None
 
 
-async def upload_optimized_image(thumbnail_id, optimized_filename, optimized_bytes):
+def primary_variant(variants):
+    """
+    Picks the variant stored in thumbnail.optimized_url: the widest WebP not wider than PRIMARY_WIDTH.
+    """
+    candidates = [variant for variant in variants if variant['format'] == "WEBP"] or variants
+    fitting = [variant for variant in candidates if variant['width'] <= PRIMARY_WIDTH]
+    if fitting:
+        return max(fitting, key=lambda variant: variant['width'])
+    return min(candidates, key=lambda variant: variant['width'])
+
+
+async def upload_optimized_image(session, thumbnail_id, optimized_filename, optimized_bytes,
+                                 content_type="image/webp"):
     """
-    Uploads the optimized image to Supabase Storage using the provided upload setup.
+    Uploads the optimized image straight from memory through the Supabase Storage REST API.
     Returns the public URL if successful, else None.
     """
-    optimized_filepath = os.path.join(TEMP_DIR, optimized_filename)
-    try:
-        # Save the optimized image to a temporary file
-        with open(optimized_filepath, 'wb') as f:
-            f.write(optimized_bytes)
-        logging.info(f"Saved optimized image to {optimized_filepath}")
-    except Exception as e:
-        logging.error(f"Error saving optimized image for Thumbnail ID {thumbnail_id}: {e}")
-        return None
+    headers = {
+        'apikey': API_KEY,
+        'Authorization': f'Bearer {API_KEY}',
+        'Content-Type': content_type,
+        'x-upsert': 'true',
+    }
+
+    async def attempt():
+        async with session.post(f"{BASE_URL}/storage/v1/object/{THUMBNAIL_BUCKET}/{optimized_filename}",
+                                data=optimized_bytes, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=UPLOAD_TIMEOUT)) as response:
+            if response.status >= 300:
+                raise HTTPStatusError(response.status, response.headers.get('Retry-After'),
+                                      f"Status {response.status}: {await response.text()}")
 
-    # Upload the image using the provided upload setup
     try:
-        with open(optimized_filepath, 'rb') as f:
-            response = supabase.storage.from_("thumbnail").upload(
-                file=f,
-                path=optimized_filename,
-                file_options={"upsert": "True", "content-type": "image/webp"}, )
-
-        # Handle the response based on the client version
-        if isinstance(response, dict) and 'Key' in response:
-            # Use get_public_url to retrieve the public URL
-            public_url_response = supabase.storage.from_("thumbnail").get_public_url(optimized_filename)
-            optimized_url = public_url_response.public_url
-            logging.info(f"Uploaded optimized image for Thumbnail ID {thumbnail_id} to {optimized_url}")
-            return optimized_url
-        else:
-            # If response is not a dict with 'Key', handle it as a bool
-            if response:
-                optimized_url = f"{BASE_URL}/storage/v1/object/public/thumbnail/{optimized_filename}"
-                logging.info(f"Uploaded optimized image for Thumbnail ID {thumbnail_id} to {optimized_url}")
-                return optimized_url
-            else:
-                logging.error(f"Upload failed for Thumbnail ID {thumbnail_id}: Received False")
-                return None
+        await async_call_with_retry(attempt, supabase_limiter, DB_RETRY_POLICY,
+                                    description=f"Uploading {optimized_filename}")
+        optimized_url = f"{BASE_URL}/storage/v1/object/public/{THUMBNAIL_BUCKET}/{optimized_filename}"
+        logging.info(f"Uploaded optimized image for Thumbnail ID {thumbnail_id} to {optimized_url}")
+        return optimized_url
     except Exception as e:
         logging.error(f"Failed to upload image for Thumbnail ID {thumbnail_id}: {e}")
         return None
-    finally:
-        # Clean up the temporary file
-        try:
-            os.remove(optimized_filepath)
-            logging.info(f"Deleted temporary file {optimized_filepath}")
-        except Exception as e:
-            logging.error(f"Error deleting temporary file {optimized_filepath}: {e}")
 
 
-async def process_thumbnail(session, thumbnail):
+async def optimize_source(session, thumbnail_id, image_bytes, pool, formats):
+    """
+    Encodes every responsive variant in the process pool, keeping the event loop free,
+    and uploads them to Supabase Storage.
+    Returns the primary variant's columns and the variant rows, or None on failure.
+    """
+    # Decode once and encode all variants; PIL work is CPU-bound and would otherwise block the event loop
+    generated = await asyncio.get_running_loop().run_in_executor(
+        pool, generate_variants, image_bytes, VARIANT_WIDTHS, formats)
+    if generated is None:
+        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to image processing failure.")
+        return None
+    _, _, variants = generated
+
+    # Upload every variant concurrently and collect its URL
+    uploads = []
+    for variant in variants:
+        extension, content_type = VARIANT_FILE_TYPES[variant['format']]
+        filename = f"{thumbnail_id}_{variant['width']}w.{extension}"
+        uploads.append(upload_optimized_image(session, thumbnail_id, filename, variant['data'], content_type))
+    for variant, variant_url in zip(variants, await asyncio.gather(*uploads)):
+        variant['url'] = variant_url
+    if any(variant['url'] is None for variant in variants):
+        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to upload failure.")
+        return None
+
+    primary = primary_variant(variants)
+    fields = {
+        'optimized_url': primary['url'],
+        'optimized_width': primary['width'],
+        'optimized_height': primary['height'],
+    }
+    rows = [
+        {
+            'width': variant['width'],
+            'height': variant['height'],
+            'format': variant['format'].lower(),
+            'url': variant['url'],
+            'byte_size': len(variant['data']),
+        }
+        for variant in variants
+    ]
+    return fields, rows
+
+
+async def process_thumbnail(session, thumbnail, pool, formats, writer, index):
     """
     Processes a single thumbnail:
-    - Fetches the original image.
-    - Resizes it to a max width of 640px.
-    - Uploads the optimized image to Supabase Storage.
-    - Updates the database with the optimized image URL and its dimensions.
+    - Fetches the original image, conditionally when optimized variants were stored before.
+    - Restores optimized_url from the stored variants if the source is unchanged (304).
+    - Reuses the optimized files of an already processed source with the same content or dHash.
+    - Otherwise encodes and uploads every responsive variant.
+    - Queues the variant rows and the primary variant's URL and dimensions in the write-behind buffer.
     """
     thumbnail_id = thumbnail['id']
     url = thumbnail['url']
     logging.info(f"Processing Thumbnail ID: {thumbnail_id}, URL: {url}")
 
-    # Fetch original image
-    image_bytes = await fetch_image(session, url)
-    if image_bytes is None:
+    # Fetch original image; the stored validators let an unchanged source be answered with 304
+    stored_variants = thumbnail.get('thumbnail_variants') or []
+    headers = None
+    if REFRESH or stored_variants:
+        headers = conditional_headers(thumbnail['source_etag'], thumbnail['source_last_modified'])
+    fetched = await fetch_image(session, url, headers)
+    if fetched is NOT_MODIFIED:
+        if stored_variants and not REFRESH:
+            primary = primary_variant([{**variant, 'format': variant['format'].upper()}
+                                       for variant in stored_variants])
+            await writer.add(thumbnail_id, {
+                'optimized_url': primary['url'],
+                'optimized_width': primary['width'],
+                'optimized_height': primary['height'],
+            })
+            logging.info(f"Thumbnail ID: {thumbnail_id} is unchanged. Restored its optimized variants.")
+        else:
+            logging.info(f"Thumbnail ID: {thumbnail_id} is unchanged. Skipping.")
+        return
+    if fetched is None:
         logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to fetch failure.")
         return
+    image_bytes, validators = fetched
 
-    # Get dimensions of original image
-    original_width, original_height = get_image_dimensions(image_bytes)
-    if original_width is None or original_height is None:
-        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to image processing failure.")
-        return
+    try:
+        # Reject decompression bombs from the header before any decode
+        dimensions = probe_dimensions(image_bytes)
+        if dimensions is not None and dimensions[0] * dimensions[1] > MAX_IMAGE_PIXELS:
+            logging.warning(f"Skipping Thumbnail ID: {thumbnail_id}: {dimensions[0]}x{dimensions[1]} exceeds "
+                            f"{MAX_IMAGE_PIXELS} pixels.")
+            return
+        await process_source(session, thumbnail_id, image_bytes, validators, pool, formats, writer, index)
+    finally:
+        download_budget.release(len(image_bytes))
 
-    # Resize the image
-    resized_bytes = resize_image(image_bytes, max_width=640)
-    if resized_bytes is None:
-        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to resizing failure.")
-        return
 
-    # Determine optimized image filename
-    optimized_filename = f"{thumbnail_id}.webp"
+async def reuse_source(thumbnail_id, match, fingerprint, writer, index) -> bool:
+    """Points a thumbnail at the optimized files of an indexed source. Returns False on failure."""
+    try:
+        variants = await index.variants_of(match, supabase)
+    except Exception as e:
+        logging.error(f"Error loading variants of Thumbnail ID {match['thumbnail_id']}: {e}")
+        return False
+    await writer.add(thumbnail_id, {**match['fields'], **fingerprint}, variants)
+    logging.info(f"Thumbnail ID: {thumbnail_id} reuses the optimized images of "
+                 f"Thumbnail ID: {match['thumbnail_id']}.")
+    return True
 
-    # Upload the optimized image and get its URL
-    optimized_url = await upload_optimized_image(thumbnail_id, optimized_filename, resized_bytes)
-    if optimized_url is None:
-        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to upload failure.")
-        return
 
-    # Get dimensions of optimized image
-    optimized_width, optimized_height = get_image_dimensions(resized_bytes)
-    if optimized_width is None or optimized_height is None:
-        logging.warning(f"Skipping Thumbnail ID: {thumbnail_id} due to optimized image processing failure.")
-        return
+async def process_source(session, thumbnail_id, image_bytes, validators, pool, formats, writer, index):
+    """
+    Stores a downloaded source image: reuses the optimized files of an already processed
+    source with the same content or dHash, or encodes and uploads every responsive variant.
+    """
+    source_hash = content_hash(image_bytes)
+    fingerprint = {
+        'content_hash': source_hash,
+        'source_etag': validators['etag'],
+        'source_last_modified': validators['last_modified'],
+        'source_content_length': validators['content_length'] or len(image_bytes),
+    }
+    if DEDUPLICATE_SOURCES:
+        # Claim the hash before the first await so that identical sources wait for this task
+        while True:
+            await index.wait_pending(source_hash)
+            match = index.find_exact(source_hash)
+            if match is not None or index.begin(source_hash):
+                break
+        if match is not None:
+            await reuse_source(thumbnail_id, match, fingerprint, writer, index)
+            return
 
-    # Update the thumbnail record in Supabase
+    hashed = None
+    entry = None
     try:
-        supabase.table('thumbnail').update({
-            'optimized_url': optimized_url,
-            'optimized_width': optimized_width,
-            'optimized_height': optimized_height,
-        }).eq('id', thumbnail_id).execute()
-        logging.info(f"Updated Thumbnail ID: {thumbnail_id} with optimized image details.")
-    except Exception as e:
-        logging.error(f"Error updating Thumbnail ID: {thumbnail_id}: {e}")
+        if DEDUPLICATE_SOURCES:
+            hashed = await asyncio.get_running_loop().run_in_executor(pool, compute_dhash, image_bytes)
+            if hashed is not None:
+                fingerprint['dhash'] = to_signed(hashed[0])
+                match = index.find_similar(*hashed)
+                if match is not None:
+                    if await reuse_source(thumbnail_id, match, fingerprint, writer, index):
+                        # Later exact duplicates of this source reuse the same files without hashing again
+                        entry = {**match, 'content_hash': source_hash, 'dhash': None}
+                    return
+
+        optimized = await optimize_source(session, thumbnail_id, image_bytes, pool, formats)
+        if optimized is None:
+            return
+        fields, variants = optimized
+
+        # Queue the variants together with the primary one; both are written in the same transaction
+        await writer.add(thumbnail_id, {**fields, **fingerprint}, variants)
+        logging.info(f"Queued update for Thumbnail ID: {thumbnail_id} with {len(variants)} optimized variants.")
+        entry = {
+            'thumbnail_id': thumbnail_id,
+            'content_hash': source_hash,
+            'dhash': hashed[0] if hashed is not None else None,
+            'fields': fields,
+            'variants': variants,
+        }
+    finally:
+        if DEDUPLICATE_SOURCES:
+            index.finish(source_hash, entry)
 
 
-async def fetch_thumbnails(offset):
+async def fetch_thumbnails(last_id):
     """
-    Fetches a single page of thumbnails where optimized_url is NULL.
+    Fetches the next page of thumbnails where optimized_url is NULL, in id order, with their stored variants.
+    In refresh mode it fetches optimized thumbnails with stored validators instead.
+    Keyset pagination (id > last_id) keeps every pass complete even though processed
+    rows drop out of the filter, and each page costs the same however deep the pass is.
     """
     try:
-        response = supabase.table('thumbnail') \
-            .select('id, url') \
-            .is_('optimized_url', None) \
-            .range(offset, offset + PAGE_SIZE - 1) \
-            .execute()
+        query = supabase.table('thumbnail') \
+            .select('id, url, source_etag, source_last_modified, '
+                    'thumbnail_variants(width, height, format, url, byte_size)')
+        if REFRESH:
+            query = query.not_.is_('optimized_url', None) \
+                .or_('source_etag.not.is.null,source_last_modified.not.is.null')
+        else:
+            query = query.is_('optimized_url', None)
+        query = query.order('id').limit(PAGE_SIZE)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        response = await async_call_with_retry(lambda: asyncio.to_thread(query.execute), supabase_limiter,
+                                               DB_RETRY_POLICY, retry_unknown=False,
+                                               description=f"Fetching thumbnails after id {last_id}")
 
         return response.data  # Returns a list of thumbnails
     except Exception as e:
-        logging.error(f"Error fetching thumbnails for offset {offset}: {e}")
+        logging.error(f"Error fetching thumbnails after id {last_id}: {e}")
         return []
 
 
@@ -211,42 +377,54 @@ async def main():
     """
     Main asynchronous function to process all thumbnails with pagination.
     """
-    offset = 0
+    last_id = None
     total_processed = 0
+    formats = supported_formats(VARIANT_FORMATS)
+    if not formats:
+        logging.error("None of the configured variant formats can be encoded. Exiting.")
+        return
 
-    # Use a session for all HTTP requests
-    async with aiohttp.ClientSession() as session:
-        while True:
-            thumbnails = await fetch_thumbnails(offset)
-            if not thumbnails:
-                if offset == 0:
-                    logging.info("No thumbnails to process. Exiting.")
-                else:
-                    logging.info(f"All thumbnails processed up to offset {offset - PAGE_SIZE}. Exiting.")
-                break
-
-            logging.info(f"Processing Thumbnails with offset {offset}: {len(thumbnails)} thumbnails.")
-
-            # Create a list of tasks for concurrent processing
-            tasks = [process_thumbnail(session, thumbnail) for thumbnail in thumbnails]
-
-            # Limit the number of concurrent tasks to avoid overwhelming the server
-            semaphore = asyncio.Semaphore(30)
-
-            async def sem_task(task):
-                async with semaphore:
-                    await task
-
-            # Wrap tasks with semaphore
-            sem_tasks = [sem_task(task) for task in tasks]
-
-            # Run all tasks concurrently
-            await asyncio.gather(*sem_tasks)
-
-            total_processed += len(thumbnails)
-            logging.info(f"Completed processing offset {offset}. Total thumbnails processed: {total_processed}")
-
-            offset += PAGE_SIZE  # Move to the next page
+    index = SourceIndex()
+    if DEDUPLICATE_SOURCES:
+        try:
+            await asyncio.to_thread(index.load, supabase)
+        except Exception as e:
+            logging.error(f"Error loading source fingerprints: {e}. Only duplicates found in this run are reused.")
+
+    # Use a session for all HTTP requests, a process pool for all image encoding and one buffer for all updates
+    with ProcessPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        async with aiohttp.ClientSession() as session, ThumbnailUpdateBuffer(supabase) as writer:
+            while True:
+                thumbnails = await fetch_thumbnails(last_id)
+                if not thumbnails:
+                    if last_id is None:
+                        logging.info("No thumbnails to process. Exiting.")
+                    else:
+                        logging.info(f"All thumbnails processed up to id {last_id}. Exiting.")
+                    break
+
+                logging.info(f"Processing Thumbnails after id {last_id}: {len(thumbnails)} thumbnails.")
+
+                # Create a list of tasks for concurrent processing
+                tasks = [process_thumbnail(session, thumbnail, pool, formats, writer, index)
+                         for thumbnail in thumbnails]
+
+                # Limit the number of concurrent tasks to avoid overwhelming the server
+                semaphore = asyncio.Semaphore(30)
+
+                async def sem_task(task):
+                    async with semaphore:
+                        await task
+
+                # Wrap tasks with semaphore
+                sem_tasks = [sem_task(task) for task in tasks]
+
+                # Run all tasks concurrently
+                await asyncio.gather(*sem_tasks)
+
+                total_processed += len(thumbnails)
+                last_id = thumbnails[-1]['id']  # Move to the next page
+                logging.info(f"Completed processing up to id {last_id}. Total thumbnails processed: {total_processed}")
 
     logging.info("Thumbnail processing completed.")
 
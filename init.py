@@ -1,13 +1,20 @@
 import logging
+import queue
 import sys
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import List, Optional, Tuple
 
 from supabase import Client
 from tqdm import tqdm  # For progress bar
 
+from api_cache import ApiCache, item_key, listing_version, search_key
 from auth import supabase  # Ensure auth.py is in the same directory
+from checkpoint import CrawlCheckpoint
+from lookups import ReferenceLookups
+from network import RetryPolicy, call_with_retry, heritage_api_limiter, supabase_limiter
 from kheritageapi.heritage import HeritageSearcher, HeritageInfo
 from kheritageapi.models import HeritagSearchResultItem, HeritageDetail, HeritageVideoSet, HeritageImageSet
 
@@ -37,6 +44,27 @@ invalid_logger.addHandler(invalid_file_handler)
 RESULT_COUNT = 100  # Number of items per page; adjust based on API capabilities
 MAX_RETRIES = 5  # Max retries for API requests
 MAX_WORKERS = 10  # Number of worker threads
+PREFETCH_PAGES = 2  # Number of search pages fetched ahead of the workers
+MAX_IN_FLIGHT = MAX_WORKERS * 2  # Items submitted to the executor but not yet finished
+API_TIMEOUT = 60  # Seconds to wait for the detail, image and video requests of one item, retries included
+MAX_LEAKED_CALLS = MAX_WORKERS * 2  # Timed-out API calls allowed to hold api_executor threads before items fail fast
+API_RETRY_POLICY = RetryPolicy(max_retries=MAX_RETRIES, max_delay=16)  # Jittered backoff for API and RPC calls
+API_CACHE_PATH = "api_cache.sqlite3"  # On-disk cache of heritage API responses
+SEARCH_CACHE_TTL = 24 * 3600  # Seconds a cached search page stays valid; item responses follow last_modified
+
+# Separate pool for the per-item API requests so that item workers never wait on their own pool
+api_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * 3, thread_name_prefix='heritage_api')
+# kheritageapi calls cannot be interrupted, so a call that outlives API_TIMEOUT keeps its thread until it returns
+_leaked_calls = 0
+_leaked_calls_lock = threading.Lock()
+api_cache = ApiCache(API_CACHE_PATH)
+BATCH_INSERT = True  # Insert each page with one insert_heritage_items_bulk RPC instead of one RPC per item
+UPSERT = True  # Update existing uids whose last_modified changed instead of failing on the uid UNIQUE constraint
+CHECKPOINT_PATH = "crawl_checkpoint.sqlite3"  # Completed pages and failed uids, used to resume after a crash
+USE_LOOKUP_CACHE = True  # Resolve reference ids client-side and bulk insert with insert_resolved_heritage_items_bulk
+
+_reference_lookups: Optional[ReferenceLookups] = None
+_reference_lookups_lock = threading.Lock()
 
 
 def heritage_item_exists(uid: str, supabase_client: Client) -> bool:
@@ -74,130 +102,307 @@ def extract_category_names(detail: HeritageDetail) -> dict:
     }
 
 
+def build_heritage_record(detail: HeritageDetail, images: HeritageImageSet, videos: HeritageVideoSet) -> dict:
+    """
+    Normalize a heritage item with its images and videos into the record shape
+    expected by the insert stored procedures (field names without the 'p_' prefix).
+    """
+    # Prepare images data
+    images_data = [
+        {
+            'licence': img.licence,
+            'image_url': img.image_url,
+            'description': img.description
+        }
+        for img in images
+        if img.image_url and img.image_url.strip() != ''
+    ]
+
+    # Prepare videos data
+    videos_data = [
+        {'video_url': vid}
+        for vid in videos
+        if vid.strip() != ''
+    ]
+
+    # Extract district_code
+    district_code = extract_district_code(detail)
+    if not district_code:
+        logger.warning(
+            f"District code could not be extracted for heritage_item with uid {detail.uid}. Setting to NULL.")
+    else:
+        district_code = district_code.strip()
+        logger.debug(f"Extracted district_code: '{district_code}' for uid {detail.uid}")
+
+    # Extract category names
+    category_names = extract_category_names(detail)
+    if not any(category_names.values()):
+        logger.warning(
+            f"All category names are missing or empty for heritage_item with uid {detail.uid}. Setting categories to NULL.")
+        category_names = {k: None for k in category_names}  # Set all to None
+    else:
+        # Set any missing category names to None
+        for key, value in category_names.items():
+            if not value:
+                category_names[key] = None
+        logger.debug(f"Category names: {category_names} for uid {detail.uid}")
+
+    # Handle longitude and latitude: set to None if 0
+    longitude = float(detail.longitude) if detail.longitude and float(detail.longitude) != 0 else None
+    if longitude is None:
+        logger.debug(f"Longitude is 0 or missing for uid {detail.uid}. Setting to NULL.")
+    latitude = float(detail.latitude) if detail.latitude and float(detail.latitude) != 0 else None
+    if latitude is None:
+        logger.debug(f"Latitude is 0 or missing for uid {detail.uid}. Setting to NULL.")
+
+    # Convert dates to the correct format
+    def format_date(date_value):
+        if date_value and isinstance(date_value, (time.struct_time, tuple, list)):
+            return time.strftime('%Y-%m-%d', date_value)
+        elif isinstance(date_value, str):
+            return date_value  # Assume it's already in the correct format
+        return None
+
+    last_modified_date = format_date(detail.last_modified)
+    if last_modified_date:
+        logger.debug(f"Formatted last_modified_date: '{last_modified_date}'")
+    registered_date = format_date(detail.registered_date)
+    if registered_date:
+        logger.debug(f"Formatted registered_date: '{registered_date}'")
+
+    return {
+        'uid': detail.uid,
+        'name': detail.name,
+        'name_hanja': detail.name_hanja,
+        'city_code': detail.city_code if detail.city_code else None,  # Ensure it's a string or None
+        'district_code': district_code if district_code else None,
+        'heritage_type_code': detail.type_code,
+        'canceled': detail.canceled,
+        'last_modified': last_modified_date,
+        'management_number': detail.management_number,
+        'linkage_number': detail.linkage_number,
+        'longitude': longitude,
+        'latitude': latitude,
+        'type': detail.type,
+        'quantity': detail.quantity,
+        'registered_date': registered_date,
+        'location_description': detail.location_description,
+        'era': detail.era,
+        'owner': detail.owner,
+        'manager': detail.manager,
+        'thumbnail': detail.thumbnail,
+        'content': detail.content,
+        'category1_name': category_names['p_category1_name'],
+        'category2_name': category_names['p_category2_name'],
+        'category3_name': category_names['p_category3_name'],
+        'category4_name': category_names['p_category4_name'],
+        'images': images_data if images_data else None,
+        'videos': videos_data if videos_data else None
+    }
+
+
+def report_insert_result(uid: str, result) -> bool:
+    """
+    Log the result row of insert_heritage_item_with_relations; codes it could not
+    resolve go to invalid_data.log (the procedure no longer raises notices for them).
+    Returns False if the procedure rejected the item.
+    """
+    if isinstance(result, list):
+        result = result[0] if result else None
+    if not result:
+        return True
+    logger.info(f"heritage_item with uid {uid}: {result.get('status')}")
+    if result.get('unresolved'):
+        invalid_logger.warning(f"Unresolved codes for heritage_item with uid {uid}: {', '.join(result['unresolved'])}")
+    if result.get('status') == 'rejected':
+        logger.error(f"heritage_item with uid {uid} was rejected: unresolved {result.get('unresolved')}")
+        return False
+    return True
+
+
+def report_bulk_insert_result(result, record_count: int) -> List[str]:
+    """
+    Log the result of a bulk insert RPC and return the uids it rejected because a
+    city, district or heritage type code did not resolve.
+    """
+    rejected = result.get('rejected') or []
+    logger.info(f"Bulk inserted {result.get('affected')} of {record_count} heritage_items")
+    for item in rejected:
+        report_insert_result(item['uid'], {'status': 'rejected', 'unresolved': item['unresolved']})
+    return [item['uid'] for item in rejected]
+
+
+def insert_heritage_record(record: dict, supabase_client: Client) -> bool:
+    """Call the single-item stored procedure for a record built by build_heritage_record."""
+    try:
+        response = call_with_retry(
+            supabase_client.rpc(
+                'insert_heritage_item_with_relations',
+                {**{f'p_{key}': value for key, value in record.items()}, 'p_upsert': UPSERT}
+            ).execute,
+            supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+            description=f"Inserting heritage_item with uid {record['uid']}")
+        if not report_insert_result(record['uid'], response.data):
+            invalid_logger.warning(f"Invalid data for heritage_item with uid {record['uid']}: {record}")
+            return False
+
+        logger.info(f"Successfully inserted heritage_item with uid {record['uid']}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error inserting heritage_item with uid {record['uid']}: {e}")
+        # Log invalid data to invalid_data.log
+        invalid_logger.warning(f"Invalid data for heritage_item with uid {record['uid']}: {record}")
+        return False
+
+
 def call_insert_stored_procedure(detail: HeritageDetail, images: HeritageImageSet, videos: HeritageVideoSet,
                                  supabase_client: Client) -> bool:
     """Call the stored procedure to insert heritage item with images and videos."""
     try:
-        # Prepare images data
-        images_data = [
-            {
-                'licence': img.licence,
-                'image_url': img.image_url,
-                'description': img.description
-            }
-            for img in images
-            if img.image_url and img.image_url.strip() != ''
-        ]
-
-        # Prepare videos data
-        videos_data = [
-            {'video_url': vid}
-            for vid in videos
-            if vid.strip() != ''
-        ]
-
-        # Extract district_code
-        district_code = extract_district_code(detail)
-        if not district_code:
-            logger.warning(
-                f"District code could not be extracted for heritage_item with uid {detail.uid}. Setting to NULL.")
-        else:
-            district_code = district_code.strip()
-            logger.debug(f"Extracted district_code: '{district_code}' for uid {detail.uid}")
-
-        # Extract category names
-        category_names = extract_category_names(detail)
-        if not any(category_names.values()):
-            logger.warning(
-                f"All category names are missing or empty for heritage_item with uid {detail.uid}. Setting categories to NULL.")
-            category_names = {k: None for k in category_names}  # Set all to None
-        else:
-            # Set any missing category names to None
-            for key, value in category_names.items():
-                if not value:
-                    category_names[key] = None
-            logger.debug(f"Category names: {category_names} for uid {detail.uid}")
-
-        # Handle longitude and latitude: set to None if 0
-        longitude = float(detail.longitude) if detail.longitude and float(detail.longitude) != 0 else None
-        if longitude is None:
-            logger.debug(f"Longitude is 0 or missing for uid {detail.uid}. Setting to NULL.")
-        latitude = float(detail.latitude) if detail.latitude and float(detail.latitude) != 0 else None
-        if latitude is None:
-            logger.debug(f"Latitude is 0 or missing for uid {detail.uid}. Setting to NULL.")
-
-        # Convert dates to the correct format
-        def format_date(date_value):
-            if date_value and isinstance(date_value, (time.struct_time, tuple, list)):
-                return time.strftime('%Y-%m-%d', date_value)
-            elif isinstance(date_value, str):
-                return date_value  # Assume it's already in the correct format
-            return None
-
-        last_modified_date = format_date(detail.last_modified)
-        if last_modified_date:
-            logger.debug(f"Formatted last_modified_date: '{last_modified_date}'")
-        registered_date = format_date(detail.registered_date)
-        if registered_date:
-            logger.debug(f"Formatted registered_date: '{registered_date}'")
-
-        # Call the stored procedure
-        supabase_client.rpc(
-            'insert_heritage_item_with_relations',
-            {
-                'p_uid': detail.uid,
-                'p_name': detail.name,
-                'p_name_hanja': detail.name_hanja,
-                'p_city_code': detail.city_code if detail.city_code else None,  # Ensure it's a string or None
-                'p_district_code': district_code if district_code else None,
-                'p_heritage_type_code': detail.type_code,
-                'p_canceled': detail.canceled,
-                'p_last_modified': last_modified_date,
-                'p_management_number': detail.management_number,
-                'p_linkage_number': detail.linkage_number,
-                'p_longitude': longitude,
-                'p_latitude': latitude,
-                'p_type': detail.type,
-                'p_quantity': detail.quantity,
-                'p_registered_date': registered_date,
-                'p_location_description': detail.location_description,
-                'p_era': detail.era,
-                'p_owner': detail.owner,
-                'p_manager': detail.manager,
-                'p_thumbnail': detail.thumbnail,
-                'p_content': detail.content,
-                'p_category1_name': category_names['p_category1_name'],
-                'p_category2_name': category_names['p_category2_name'],
-                'p_category3_name': category_names['p_category3_name'],
-                'p_category4_name': category_names['p_category4_name'],
-                'p_images': images_data if images_data else None,
-                'p_videos': videos_data if videos_data else None
-            }
-        ).execute()
-
-        logger.info(f"Successfully inserted heritage_item with uid {detail.uid}")
-        return True
-
+        record = build_heritage_record(detail, images, videos)
     except Exception as e:
-        logger.error(f"Error inserting heritage_item with uid {detail.uid}: {e}")
+        logger.error(f"Error preparing heritage_item with uid {detail.uid}: {e}")
         # Log invalid data to invalid_data.log
         invalid_logger.warning(f"Invalid data for heritage_item with uid {detail.uid}: {detail.__dict__}")
         return False
+    return insert_heritage_record(record, supabase_client)
+
+
+def get_reference_lookups(supabase_client: Client) -> ReferenceLookups:
+    """Load the reference tables on first use and share them between all workers."""
+    global _reference_lookups
+    with _reference_lookups_lock:
+        if _reference_lookups is None:
+            _reference_lookups = ReferenceLookups(supabase_client)
+        return _reference_lookups
+
+
+def bulk_insert_request(records: List[dict], supabase_client: Client) -> Tuple[str, dict, List[str]]:
+    """
+    Name and parameters of the bulk insert RPC for a page of records, plus the uids rejected
+    before sending. With USE_LOOKUP_CACHE the records are resolved to ids first and sent to
+    the slimmer procedure; records with an unresolved city, district or heritage type are
+    reported and left out, since they cannot satisfy the NOT NULL columns.
+    """
+    if not USE_LOOKUP_CACHE:
+        return 'insert_heritage_items_bulk', {'p_items': records, 'p_upsert': UPSERT}, []
+
+    lookups = get_reference_lookups(supabase_client)
+    items, rejected = [], []
+    for record in records:
+        resolved, unresolved = lookups.resolve(record)
+        if unresolved:
+            report_insert_result(record['uid'], {'status': 'rejected', 'unresolved': unresolved})
+            rejected.append(record['uid'])
+        else:
+            items.append(resolved)
+    return 'insert_resolved_heritage_items_bulk', {'p_items': items, 'p_upsert': UPSERT}, rejected
+
+
+def call_bulk_insert_stored_procedure(records: List[dict], supabase_client: Client) -> List[str]:
+    """
+    Insert a whole page of records with a single bulk insert RPC.
+    If the batch is rejected, fall back to one RPC per record so that a single
+    invalid item does not cost the rest of the page.
+    Returns the uids of the records that could not be inserted.
+    """
+    if not records:
+        return []
+
+    try:
+        function, params, rejected = bulk_insert_request(records, supabase_client)
+        if not params['p_items']:
+            return rejected
+        response = call_with_retry(
+            supabase_client.rpc(function, params).execute,
+            supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+            description=f"Bulk inserting {len(records)} heritage_items")
+        return rejected + report_bulk_insert_result(response.data, len(records))
+    except Exception as e:
+        logger.error(f"Bulk insert of {len(records)} heritage_items failed: {e}. Falling back to per-item inserts.")
+
+    return [record['uid'] for record in records if not insert_heritage_record(record, supabase_client)]
+
 
+def track_leaked_calls(futures: List[Future]) -> None:
+    """Count running calls whose item already timed out until each of them returns."""
+    global _leaked_calls
 
-def process_heritage_item(result, supabase_client: Client) -> None:
-    """Process a single heritage item: check existence, retrieve details, and insert into DB."""
+    def release(_):
+        global _leaked_calls
+        with _leaked_calls_lock:
+            _leaked_calls -= 1
+
+    with _leaked_calls_lock:
+        _leaked_calls += len(futures)
+    for future in futures:
+        future.add_done_callback(release)
+
+
+def retrieve_heritage_parts(result) -> Tuple[HeritageDetail, HeritageImageSet, HeritageVideoSet]:
+    """
+    Retrieve details, images and videos of a search result concurrently.
+    Cached responses are reused while the listing reports the same last_modified.
+    Raises TimeoutError if the three requests do not finish within API_TIMEOUT, and
+    fails right away while MAX_LEAKED_CALLS timed-out calls still occupy api_executor.
+    """
+    with _leaked_calls_lock:
+        if _leaked_calls >= MAX_LEAKED_CALLS:
+            raise RuntimeError(f"{_leaked_calls} timed-out API calls are still running; "
+                               f"not starting requests for uid {result.uid}")
+    item = HeritageInfo(result)
+    version = listing_version(result)
+    futures = [
+        api_executor.submit(
+            api_cache.get_or_fetch,
+            item_key(endpoint, result.uid),
+            partial(call_with_retry, call, heritage_api_limiter, API_RETRY_POLICY,
+                    description=f"{call.__name__} for uid {result.uid}"),
+            version)
+        for endpoint, call in (('detail', item.retrieve_detail), ('image', item.retrieve_image),
+                               ('video', item.retrieve_video))
+    ]
+    _, not_done = wait(futures, timeout=API_TIMEOUT)
+    if not_done:
+        # Queued calls are dropped; running ones cannot be stopped and are counted until they return
+        running = [future for future in not_done if not future.cancel()]
+        if running:
+            track_leaked_calls(running)
+            logger.warning(f"{len(running)} API calls for uid {result.uid} are still running after {API_TIMEOUT}s "
+                           f"and keep their api_executor threads ({_leaked_calls} in total)")
+        raise TimeoutError(f"API requests for uid {result.uid} did not finish within {API_TIMEOUT}s")
+    detail, images, videos = (future.result() for future in futures)
+    return detail, images, videos
+
+
+def retrieve_heritage_record(result) -> Optional[dict]:
+    """Retrieve details, images and videos for a search result and build its insert record."""
+    uid = result.uid
+    try:
+        detail, images, videos = retrieve_heritage_parts(result)
+        return build_heritage_record(detail, images, videos)
+    except Exception as e:
+        logger.exception(f"Exception occurred while retrieving heritage_item with uid {uid}: {e}")
+        # Log invalid data to invalid_data.log
+        invalid_logger.warning(
+            f"Exception data for uid {uid}: {result.__dict__ if hasattr(result, '__dict__') else str(result)}")
+        return None
+
+
+def process_heritage_item(result, supabase_client: Client) -> bool:
+    """
+    Process a single heritage item: check existence, retrieve details, and insert into DB.
+    Returns False if the item could not be stored.
+    """
     uid = result.uid
     try:
-        # if heritage_item_exists(uid, supabase_client):
-        #     logger.info(f"Heritage item with uid {uid} already exists. Skipping.")
-        #     return
+        if not UPSERT and heritage_item_exists(uid, supabase_client):
+            logger.info(f"Heritage item with uid {uid} already exists. Skipping.")
+            return True
 
         # Retrieve detailed information
-        item = HeritageInfo(result)
-        detail: HeritageDetail = item.retrieve_detail()
-        images: HeritageImageSet = item.retrieve_image()
-        videos: HeritageVideoSet = item.retrieve_video()
+        detail, images, videos = retrieve_heritage_parts(result)
 
         # Insert into the database using the stored procedure
         insertion_success = call_insert_stored_procedure(detail, images, videos, supabase_client)
@@ -205,82 +410,194 @@ def process_heritage_item(result, supabase_client: Client) -> None:
             logger.critical(f"Insertion failed for heritage_item with uid {uid}.")
             # Depending on requirements, you might choose to raise an exception here
             # to halt processing or continue. Here, we'll continue.
+        return insertion_success
     except Exception as e:
         logger.exception(f"Exception occurred while processing heritage_item with uid {uid}: {e}")
         # Log invalid data to invalid_data.log
         invalid_logger.warning(
             f"Exception data for uid {uid}: {result.__dict__ if hasattr(result, '__dict__') else str(result)}")
         # Do not re-raise to allow other tasks to continue
+        return False
 
 
-def main():
-    page_index = 159
-    total_pages = None
+class PageProgress:
+    """Tracks the outstanding items of one search page while they finish out of order."""
 
-    # Initialize ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        while True:
-            logger.info(f"Starting page {page_index}")
+    def __init__(self, page_index: int, uids: List[str]):
+        self.page_index = page_index
+        self.uids = uids
+        self.remaining = len(uids)
+        self.records: List[dict] = []
+        self.failed_uids = set()
+        self._lock = threading.Lock()
 
-            # Initialize HeritageSearcher
-            search = HeritageSearcher(result_count=RESULT_COUNT, page_index=page_index)
-            retries = 0
-            success = False
-            while retries < MAX_RETRIES and not success:
-                try:
-                    results: HeritagSearchResultItem = search.perform_search()
-                    success = True
-                except Exception as e:
-                    retries += 1
-                    logger.error(f"Error fetching page {page_index}: {e}. Retry {retries}/{MAX_RETRIES}")
-                    time.sleep(2 ** retries)  # Exponential backoff
-
-            if not success:
-                logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries. Exiting.")
-                sys.exit(1)
+    def item_done(self, uid: str, outcome) -> bool:
+        """Record the outcome of one item. Returns True once every item of the page has finished."""
+        with self._lock:
+            if isinstance(outcome, dict):
+                self.records.append(outcome)
+            elif not outcome:
+                self.failed_uids.add(uid)
+            self.remaining -= 1
+            return self.remaining == 0
 
-            if total_pages is None:
-                try:
-                    total_items = int(results.hits)  # Convert to integer
-                except ValueError:
-                    logger.error(f"Invalid total_items value: {results.hits}. It must be an integer.")
-                    # Log invalid data to invalid_data.log
-                    invalid_logger.warning(f"Invalid total_items value: {results.hits}")
-                    sys.exit(1)
 
-                total_pages = (total_items // RESULT_COUNT) + (1 if total_items % RESULT_COUNT > 0 else 0)
-                logger.info(f"Total items: {total_items}, Total pages: {total_pages}")
+def fetch_search_page(page_index: int) -> HeritagSearchResultItem:
+    """Fetch one search page with jittered backoff. Raises the last error once MAX_RETRIES is reached."""
+    search = HeritageSearcher(result_count=RESULT_COUNT, page_index=page_index)
+    try:
+        return api_cache.get_or_fetch(
+            search_key(RESULT_COUNT, page_index),
+            partial(call_with_retry, search.perform_search, heritage_api_limiter, API_RETRY_POLICY,
+                    description=f"Fetching page {page_index}"),
+            ttl=SEARCH_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"Error fetching page {page_index}: {e}")
+        raise
+
+
+def prefetch_pages(page_indices: List[int], page_queue: queue.Queue) -> None:
+    """
+    Producer: fetch search pages ahead of the workers. The bounded queue keeps
+    at most PREFETCH_PAGES pages waiting; a failed page ends the stream.
+    """
+    for page_index in page_indices:
+        try:
+            results = fetch_search_page(page_index)
+        except Exception as e:
+            page_queue.put((page_index, e))
+            return
+        page_queue.put((page_index, results))
+        if not results.items:
+            return
+    page_queue.put(None)
+
+
+def finalize_page(progress: PageProgress, checkpoint: CrawlCheckpoint) -> None:
+    """Insert the collected records of a finished page and record it in the checkpoint."""
+    page_index = progress.page_index
+    failed_uids = set(progress.failed_uids)
+    if BATCH_INSERT:
+        failed_uids.update(call_bulk_insert_stored_procedure(progress.records, supabase))
+    if failed_uids:
+        logger.critical(f"Insertion failed for {len(failed_uids)} heritage_items on page {page_index}.")
+
+    for uid in failed_uids:
+        checkpoint.record_failure(uid, page_index)
+    checkpoint.clear_failures(uid for uid in progress.uids if uid not in failed_uids)
+    checkpoint.mark_page_completed(page_index)
+    logger.info(f"Completed page {page_index}")
+
+
+def handle_item_done(progress: PageProgress, uid: str, checkpoint: CrawlCheckpoint, pbar: tqdm,
+                     future: Future) -> None:
+    """Done-callback of an item future; the last item of a page finalizes that page."""
+    try:
+        outcome = future.result()  # We have already handled exceptions in the worker
+    except Exception as e:
+        # This block should not be reached as exceptions are handled inside the worker
+        logger.exception(f"Unhandled exception for uid {uid}: {e}")
+        invalid_logger.warning(f"Unhandled exception data for uid {uid}: {str(e)}")
+        outcome = None
+    pbar.update(1)
+    if progress.item_done(uid, outcome):
+        finalize_page(progress, checkpoint)
+
+
+def resume_crawl(checkpoint: CrawlCheckpoint) -> Tuple[int, List[int], HeritagSearchResultItem]:
+    """
+    Fetch the first pending search page of a crawl and work out which pages still need work.
+    Returns the total number of items, the pending pages and the results of the first of them.
+    Exits if the search API cannot be reached or reports an invalid total.
+    """
+    page_index = checkpoint.next_pending_page(1)
+    if page_index > 1:
+        logger.info(f"Resuming from checkpoint at page {page_index}")
+
+    try:
+        results: HeritagSearchResultItem = fetch_search_page(page_index)
+        try:
+            total_items = int(results.hits)  # Convert to integer
+        except ValueError:
+            logger.error(f"Invalid total_items value: {results.hits}. It must be an integer.")
+            # Log invalid data to invalid_data.log
+            invalid_logger.warning(f"Invalid total_items value: {results.hits}")
+            sys.exit(1)
+
+        pending_pages = checkpoint.resume(total_items, RESULT_COUNT)
+        # A changed total discards the checkpoint, so the page fetched above may no longer be the first
+        if pending_pages and pending_pages[0] != page_index:
+            page_index = pending_pages[0]
+            results = fetch_search_page(page_index)
+    except Exception:
+        logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries. Exiting.")
+        sys.exit(1)
+
+    total_pages = (total_items // RESULT_COUNT) + (1 if total_items % RESULT_COUNT > 0 else 0)
+    logger.info(f"Total items: {total_items}, Total pages: {total_pages}")
+    return total_items, pending_pages, results
 
-            if not results.items:
-                logger.info(f"No items found on page {page_index}. Ending pagination.")
-                break
 
-            # Use tqdm to create a progress bar for the current page
-            with tqdm(total=len(results.items), desc=f"Processing page {page_index}", unit="item") as pbar:
-                # Submit tasks to the executor
-                future_to_uid = {
-                    executor.submit(process_heritage_item, result, supabase): result.uid
-                    for result in results.items
-                }
-
-                for future in as_completed(future_to_uid):
-                    uid = future_to_uid[future]
-                    try:
-                        future.result()  # We have already handled exceptions in process_heritage_item
-                    except Exception as e:
-                        # This block should not be reached as exceptions are handled inside process_heritage_item
-                        logger.exception(f"Unhandled exception for uid {uid}: {e}")
-                        invalid_logger.warning(f"Unhandled exception data for uid {uid}: {str(e)}")
-                    finally:
-                        pbar.update(1)
-
-            logger.info(f"Completed page {page_index}")
-            page_index += 1
-
-            if page_index > total_pages:
+def main():
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH, 'init')
+    total_items, pending_pages, results = resume_crawl(checkpoint)
+
+    # The first page is already fetched; the producer thread fetches the rest ahead of the workers
+    page_queue = queue.Queue(maxsize=PREFETCH_PAGES)
+    page_queue.put((pending_pages[0], results) if pending_pages else None)
+    producer = threading.Thread(target=prefetch_pages, args=(pending_pages[1:], page_queue), daemon=True)
+    producer.start()
+
+    # Bounds the executor's backlog so that items are pulled from the page queue only as workers free up
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    fetch_failed = False
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            tqdm(total=min(total_items, len(pending_pages) * RESULT_COUNT), desc="Processing items",
+                 unit="item") as pbar:
+        while True:
+            entry = page_queue.get()
+            if entry is None:
                 logger.info("All pages processed.")
                 break
 
+            page_index, results = entry
+            if isinstance(results, Exception):
+                logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries. Exiting.")
+                fetch_failed = True
+                break
+
+            if not results.items:
+                logger.info(f"No items found on page {page_index}. Ending pagination.")
+                break
+            logger.info(f"Starting page {page_index}")
+
+            # A page that was already completed is only revisited for the uids that failed
+            items = results.items
+            if page_index in checkpoint.completed_pages():
+                retry_uids = checkpoint.failed_uids(page_index)
+                items = [result for result in items if result.uid in retry_uids]
+                logger.info(f"Retrying {len(items)} failed items on page {page_index}")
+
+            progress = PageProgress(page_index, [result.uid for result in items])
+            if not items:
+                finalize_page(progress, checkpoint)
+                continue
+
+            # Items of this page queue up behind the stragglers of the previous one
+            for result in items:
+                in_flight.acquire()
+                if BATCH_INSERT:
+                    future = executor.submit(retrieve_heritage_record, result)
+                else:
+                    future = executor.submit(process_heritage_item, result, supabase)
+                future.add_done_callback(lambda _: in_flight.release())
+                future.add_done_callback(partial(handle_item_done, progress, result.uid, checkpoint, pbar))
+
+    checkpoint.close()
+    api_cache.close()
+    if fetch_failed:
+        sys.exit(1)
     logger.info("Database population completed successfully.")
 
 
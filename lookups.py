@@ -0,0 +1,117 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from supabase import Client
+
+from network import RetryPolicy, call_with_retry, supabase_limiter
+
+logger = logging.getLogger('main_logger')
+
+# Constants
+LOAD_PAGE_SIZE = 1000  # Rows per request when loading a table; PostgREST caps responses at 1000 by default
+LOOKUP_RETRY_POLICY = RetryPolicy(max_retries=5, max_delay=16)  # Backoff for lookup queries and category creation
+
+CATEGORY_LEVELS = 4  # categories.level is between 1 and 4
+
+
+def load_table(client: Client, table: str, columns: str, key: str = 'id', where: Optional[Callable] = None,
+               retry_policy: RetryPolicy = LOOKUP_RETRY_POLICY) -> list:
+    """
+    Read a whole table in key order, one page at a time. key must be unique and among columns;
+    where can add filters to the query builder. Keyset pages (key > last key) cost the same
+    however deep the read is, unlike OFFSET.
+    """
+    rows = []
+    last_key = None
+    while True:
+        query = client.table(table).select(columns).order(key).limit(LOAD_PAGE_SIZE)
+        if where is not None:
+            query = where(query)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        page = call_with_retry(query.execute, supabase_limiter, retry_policy, retry_unknown=False,
+                               description=f"Loading {table} after {key} {last_key}").data
+        rows.extend(page)
+        if len(page) < LOAD_PAGE_SIZE:
+            return rows
+        last_key = page[-1][key]
+
+
+class ReferenceLookups:
+    """
+    In-memory copy of the reference tables used by the insert procedures.
+    cities, districts and heritage_types are immutable, so they are loaded once.
+    The category hierarchy is kept as a tree keyed by (parent_id, name); a
+    category that is not known yet is created through get_or_create_category
+    and added to the tree, so each one costs a database round trip only once.
+    """
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.cities: Dict[str, int] = {
+            row['code']: row['id'] for row in load_table(client, 'cities', 'id, code')}
+        self.districts: Dict[Tuple[int, str], int] = {
+            (row['city_id'], row['code']): row['id'] for row in load_table(client, 'districts', 'id, city_id, code')}
+        self.heritage_types: Dict[str, int] = {
+            row['code']: row['id'] for row in load_table(client, 'heritage_types', 'id, code')}
+        self.categories: Dict[Tuple[Optional[int], str], int] = {}
+        for row in load_table(client, 'categories', 'id, name, parent_id, level'):
+            # Keep the oldest row of level-1 duplicates left over from before UNIQUE NULLS NOT DISTINCT
+            self.categories.setdefault((row['parent_id'], row['name']), row['id'])
+        self._lock = threading.Lock()
+        logger.info(f"Loaded {len(self.cities)} cities, {len(self.districts)} districts, "
+                    f"{len(self.heritage_types)} heritage types and {len(self.categories)} categories")
+
+    def category_id(self, name: str, parent_id: Optional[int], level: int) -> int:
+        key = (parent_id, name)
+        category_id = self.categories.get(key)
+        if category_id is not None:
+            return category_id
+        with self._lock:
+            category_id = self.categories.get(key)
+            if category_id is None:
+                category_id = call_with_retry(
+                    self.client.rpc('get_or_create_category',
+                                    {'p_name': name, 'p_parent_id': parent_id, 'p_level': level}).execute,
+                    supabase_limiter, LOOKUP_RETRY_POLICY, retry_unknown=False,
+                    description=f"Creating category {name!r} at level {level}").data
+                self.categories[key] = category_id
+                logger.info(f"Created category_id {category_id} for {name!r} at level {level}")
+            return category_id
+
+    def resolve(self, record: dict) -> Tuple[dict, List[str]]:
+        """
+        Replace the codes and category names of a record built by build_heritage_record
+        with the ids expected by insert_resolved_heritage_items_bulk. Also returns the
+        codes that did not resolve; city_id, district_id and heritage_type_id are NOT NULL,
+        so such a record cannot be inserted and its categories are not created.
+        """
+        resolved = {key: value for key, value in record.items()
+                    if key not in ('city_code', 'district_code', 'heritage_type_code')
+                    and not (key.startswith('category') and key.endswith('_name'))}
+        unresolved = []
+
+        city_id = self.cities.get(record['city_code'])
+        if city_id is None:
+            unresolved.append(f"city_code:{record['city_code']}")
+        district_id = self.districts.get((city_id, record['district_code'])) if city_id is not None else None
+        if district_id is None and city_id is not None:
+            unresolved.append(f"district_code:{record['district_code']}")
+        heritage_type_id = self.heritage_types.get(record['heritage_type_code'])
+        if heritage_type_id is None:
+            unresolved.append(f"heritage_type_code:{record['heritage_type_code']}")
+        resolved.update(city_id=city_id, district_id=district_id, heritage_type_id=heritage_type_id)
+        if unresolved:
+            return resolved, unresolved
+
+        # A level is only resolved when every level above it is
+        parent_id = None
+        for level in range(1, CATEGORY_LEVELS + 1):
+            name = record.get(f'category{level}_name')
+            category_id = None
+            if name and (level == 1 or parent_id is not None):
+                category_id = self.category_id(name, parent_id, level)
+            resolved[f'category{level}_id'] = category_id
+            parent_id = category_id
+        return resolved, unresolved
@@ -1,16 +1,20 @@
+from api_cache import ApiCache, item_key, listing_version, search_key
 from kheritageapi.heritage import HeritageSearcher, HeritageInfo
 from kheritageapi.models import HeritagSearchResultItem, HeritageDetail, HeritageVideoSet, HeritageImageSet, \
     HeritageImageItem
 
+cache = ApiCache("api_cache.sqlite3")  # Re-runs replay responses from disk
+
 search = HeritageSearcher(result_count=10, page_index=1)
-results: HeritagSearchResultItem = search.perform_search()
+results: HeritagSearchResultItem = cache.get_or_fetch(search_key(10, 1), search.perform_search, ttl=24 * 3600)
 print(results.hits)  # total count of search results
 
 for (result) in results.items:
     item: HeritageInfo = HeritageInfo(result)
-    detail: HeritageDetail = item.retrieve_detail()
-    images: HeritageImageSet = item.retrieve_image()
-    videos: HeritageVideoSet = item.retrieve_video()
+    version = listing_version(result)
+    detail: HeritageDetail = cache.get_or_fetch(item_key('detail', result.uid), item.retrieve_detail, version)
+    images: HeritageImageSet = cache.get_or_fetch(item_key('image', result.uid), item.retrieve_image, version)
+    videos: HeritageVideoSet = cache.get_or_fetch(item_key('video', result.uid), item.retrieve_video, version)
 
     print(detail)
 
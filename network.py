@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger('main_logger')
+
+T = TypeVar('T')
+
+# Returned instead of a body when a conditional request is answered with 304
+NOT_MODIFIED = object()
+
+# HTTP statuses that are worth retrying; 429 additionally slows the limiter down
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# HTTP statuses PostgREST answers its connection-level error codes with
+POSTGREST_ERROR_STATUSES = {'PGRST000': 503, 'PGRST001': 503, 'PGRST002': 503, 'PGRST003': 504}
+# Exception class names (anywhere in the MRO) that indicate a transient transport failure
+TRANSIENT_ERROR_NAMES = {
+    'ConnectionError', 'TimeoutError', 'Timeout', 'TimeoutException', 'TransportError',
+    'ClientConnectionError', 'ServerDisconnectedError', 'ClientPayloadError',
+}
+
+
+class HTTPStatusError(Exception):
+    """Raised for a non-success HTTP status so that retry decisions can be made on it."""
+
+    def __init__(self, status: int, retry_after: Optional[str] = None, message: str = ""):
+        super().__init__(message or f"Status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ResponseTooLarge(HTTPStatusError):
+    """Raised when a response body exceeds the allowed size; reported as 413 so it is never retried."""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(413, message=f"Response of {size} bytes exceeds the limit of {limit} bytes")
+
+
+class ByteBudget:
+    """
+    Global budget of response bytes held in memory by concurrent downloads.
+    A download reserves its expected size before reading the body and the
+    caller releases it once the bytes are no longer needed, so the total
+    stays bounded no matter how many downloads are in flight.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self._condition: Optional[asyncio.Condition] = None  # Created on first use inside the running loop
+
+    async def acquire(self, size: int) -> int:
+        """Waits until size bytes (at most the whole budget) are free and reserves them. Returns the reservation."""
+        size = min(size, self.capacity)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use + size <= self.capacity)
+            self.in_use += size
+        return size
+
+    def take(self, size: int) -> None:
+        """Reserves size more bytes without waiting; used when a body outgrows its reservation."""
+        self.in_use += size
+
+    def release(self, size: int) -> None:
+        self.in_use = max(0, self.in_use - size)
+        if self._condition is not None:
+            asyncio.get_running_loop().create_task(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter usable from threads and from asyncio.
+    The rate adapts AIMD-style: it is halved on HTTP 429 and grows back
+    slowly with every successful call, up to max_rate.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take one token and return how long the caller has to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+    def on_throttled(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"Throttled by upstream; rate lowered to {self.rate:.1f}/s")
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter; honours Retry-After when the server sends one."""
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+
+def http_status(exc: BaseException) -> Optional[int]:
+    """
+    Extract an HTTP status from aiohttp, httpx, requests, postgrest or HTTPStatusError
+    exceptions. postgrest's APIError carries no response, only a code: the status
+    itself for a non-JSON error body, or a PGRST code for a failed database connection.
+    """
+    status = getattr(exc, 'status', None)
+    if isinstance(status, int):
+        return status
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    if isinstance(status, int):
+        return status
+    code = getattr(exc, 'code', None)
+    if isinstance(code, str):
+        if code.isdigit() and len(code) == 3:
+            return int(code)
+        if code in POSTGREST_ERROR_STATUSES:
+            return POSTGREST_ERROR_STATUSES[code]
+    cause = exc.__cause__ or exc.__context__
+    return http_status(cause) if cause is not None else None
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Return the Retry-After delay carried by an exception, if any."""
+    value = getattr(exc, 'retry_after', None)
+    if value is None:
+        headers = getattr(exc, 'headers', None) or getattr(getattr(exc, 'response', None), 'headers', None)
+        value = headers.get('Retry-After') if headers else None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None  # HTTP-date values are not worth parsing here
+
+
+def is_retryable(exc: BaseException, retry_unknown: bool) -> bool:
+    """
+    Decide whether a failed call should be retried. Errors with an HTTP status
+    are retried only for RETRYABLE_STATUSES; transport errors always are; any
+    other error depends on retry_unknown.
+    """
+    status = http_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    if isinstance(exc, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(exc).__mro__):
+        return True
+    return retry_unknown
+
+
+def _on_failure(exc: Exception, attempt: int, limiter: Optional[TokenBucket], policy: RetryPolicy,
+                retry_unknown: bool, description: str) -> float:
+    """Shared bookkeeping for a failed attempt. Re-raises when the call should not be retried."""
+    if attempt >= policy.max_retries or not is_retryable(exc, retry_unknown):
+        raise exc
+    retry_after = retry_after_seconds(exc)
+    if limiter is not None and http_status(exc) == 429:
+        limiter.on_throttled(retry_after)
+    delay = policy.backoff(attempt, retry_after)
+    logger.warning(f"{description} failed: {exc}. Retry {attempt + 1}/{policy.max_retries} in {delay:.1f}s")
+    return delay
+
+
+def call_with_retry(func: Callable[[], T], limiter: Optional[TokenBucket] = None,
+                    policy: Optional[RetryPolicy] = None, retry_unknown: bool = True,
+                    description: str = "Request") -> T:
+    """Call a blocking function under the rate limiter, retrying transient failures."""
+    policy = policy or DEFAULT_RETRY_POLICY
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = func()
+        except Exception as e:
+            time.sleep(_on_failure(e, attempt, limiter, policy, retry_unknown, description))
+            attempt += 1
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
+
+
+async def async_call_with_retry(func: Callable[[], Awaitable[T]], limiter: Optional[TokenBucket] = None,
+                                policy: Optional[RetryPolicy] = None, retry_unknown: bool = True,
+                                description: str = "Request") -> T:
+    """Await a coroutine factory under the rate limiter, retrying transient failures."""
+    policy = policy or DEFAULT_RETRY_POLICY
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire_async()
+        try:
+            result = await func()
+        except Exception as e:
+            await asyncio.sleep(_on_failure(e, attempt, limiter, policy, retry_unknown, description))
+            attempt += 1
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
+
+
+def conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> Dict[str, str]:
+    """Request headers that let the server answer 304 when the resource still has these validators."""
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def response_validators(response) -> Dict[str, Any]:
+    """ETag, Last-Modified and full content length of an aiohttp response (also for 206 partial responses)."""
+    content_length = None
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        content_length = int(content_range.rsplit('/', 1)[1])
+    elif response.status == 200 and response.headers.get('Content-Length'):
+        content_length = int(response.headers['Content-Length'])
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_length': content_length,
+    }
+
+
+async def read_limited(response, max_bytes: int, budget: ByteBudget, chunk_size: int = 64 * 1024) -> bytes:
+    """
+    Streams an aiohttp response body, refusing bodies larger than max_bytes.
+    The bytes stay reserved in budget on return; the caller releases len(body) when done with it.
+    """
+    if response.content_length is not None and response.content_length > max_bytes:
+        raise ResponseTooLarge(response.content_length, max_bytes)
+    reserved = await budget.acquire(response.content_length or max_bytes)
+    data = bytearray()
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ResponseTooLarge(len(data), max_bytes)
+            if len(data) > reserved:
+                budget.take(len(data) - reserved)
+                reserved = len(data)
+    except BaseException:
+        budget.release(reserved)
+        raise
+    budget.release(reserved - len(data))
+    return bytes(data)
+
+
+def raise_for_status(response) -> None:
+    """Raise HTTPStatusError for a non-2xx aiohttp response."""
+    if response.status >= 300:
+        raise HTTPStatusError(response.status, response.headers.get('Retry-After'))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# Limiters shared by every caller in the process, one per upstream service
+heritage_api_limiter = TokenBucket(rate=float(os.getenv("HERITAGE_API_RATE", 20)))  # Requests per second, all modes
+supabase_limiter = TokenBucket(rate=50)
+image_host_limiter = TokenBucket(rate=50)
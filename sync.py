@@ -0,0 +1,164 @@
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from supabase import Client
+
+from api_cache import listing_version
+from auth import supabase  # Ensure auth.py is in the same directory
+from checkpoint import CrawlCheckpoint
+from init import (logger, invalid_logger, retrieve_heritage_record, call_bulk_insert_stored_procedure, RESULT_COUNT,
+                  MAX_WORKERS, MAX_RETRIES, API_RETRY_POLICY, CHECKPOINT_PATH)
+from kheritageapi.heritage import HeritageSearcher
+from kheritageapi.models import HeritagSearchResultItem
+from lookups import load_table
+from network import call_with_retry, heritage_api_limiter, supabase_limiter
+
+# Constants
+CANCEL_CHUNK_SIZE = 200  # uids per update when marking dropped items as canceled
+MAX_CANCEL_FRACTION = 0.1  # Refuse to cancel more than this share of active items in one run (likely an API glitch)
+
+
+def normalize_date(value) -> Optional[str]:
+    """Reduce a date in any of the API or database formats to 'YYYYMMDD' so that it compares as a string."""
+    if value is None:
+        return None
+    digits = re.sub(r'\D', '', str(value))
+    return digits[:8] if len(digits) >= 8 else None
+
+
+def load_watermarks(supabase_client: Client) -> Dict[str, Tuple[Optional[str], bool]]:
+    """Load the stored last_modified and canceled flag of every heritage item, keyed by uid."""
+    rows = load_table(supabase_client, 'heritage_items', 'uid, last_modified, canceled', key='uid',
+                      retry_policy=API_RETRY_POLICY)
+    watermarks = {row['uid']: (normalize_date(row['last_modified']), bool(row['canceled'])) for row in rows}
+    logger.info(f"Loaded watermarks for {len(watermarks)} heritage items")
+    return watermarks
+
+
+def needs_refresh(result, watermarks: Dict[str, Tuple[Optional[str], bool]], checked: Dict[str, str]) -> bool:
+    """
+    An item is refetched when it is new or its listing shows a newer modification date. An item
+    marked canceled that is listed again is also refetched once per listed date, to see whether it
+    is still canceled; checked holds the listed date of that last re-check.
+    """
+    if result.uid not in watermarks:
+        return True
+    stored_modified, canceled = watermarks[result.uid]
+    listed_modified = normalize_date(listing_version(result))
+    if listed_modified is not None and (stored_modified is None or listed_modified > stored_modified):
+        return True
+    return canceled and checked.get(result.uid) != (listed_modified or '')
+
+
+def fetch_listing_page(page_index: int) -> HeritagSearchResultItem:
+    """Fetch one search page. The response cache is bypassed so that the sync always sees today's listing."""
+    search = HeritageSearcher(result_count=RESULT_COUNT, page_index=page_index)
+    return call_with_retry(search.perform_search, heritage_api_limiter, API_RETRY_POLICY,
+                           description=f"Fetching page {page_index}")
+
+
+def mark_canceled(uids: List[str], supabase_client: Client) -> None:
+    """Flag items that no longer appear in the listing as canceled."""
+    for start in range(0, len(uids), CANCEL_CHUNK_SIZE):
+        chunk = uids[start:start + CANCEL_CHUNK_SIZE]
+        query = supabase_client.table('heritage_items').update({'canceled': True}).in_('uid', chunk)
+        call_with_retry(query.execute, supabase_limiter, API_RETRY_POLICY, retry_unknown=False,
+                        description=f"Marking {len(chunk)} heritage_items as canceled")
+    logger.info(f"Marked {len(uids)} heritage_items as canceled")
+
+
+def main():
+    """
+    Incremental sync: walk the listing once, fetch details, images and videos only
+    for new or modified items, upsert them, and mark items that dropped out as canceled.
+    """
+    watermarks = load_watermarks(supabase)
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH, 'sync')
+    checked = checkpoint.checked_versions()
+    seen_uids: Set[str] = set()
+    listing_complete = True
+    refreshed = 0
+    failed = 0
+
+    page_index = 1
+    total_pages = None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while total_pages is None or page_index <= total_pages:
+            try:
+                results = fetch_listing_page(page_index)
+            except Exception as e:
+                logger.critical(f"Failed to fetch page {page_index} after {MAX_RETRIES} retries: {e}")
+                listing_complete = False
+                break
+
+            if total_pages is None:
+                try:
+                    total_items = int(results.hits)  # Convert to integer
+                except ValueError:
+                    logger.error(f"Invalid total_items value: {results.hits}. It must be an integer.")
+                    invalid_logger.warning(f"Invalid total_items value: {results.hits}")
+                    sys.exit(1)
+                total_pages = (total_items // RESULT_COUNT) + (1 if total_items % RESULT_COUNT > 0 else 0)
+                logger.info(f"Total items: {total_items}, Total pages: {total_pages}")
+
+            if not results.items:
+                logger.info(f"No items found on page {page_index}. Ending pagination.")
+                break
+
+            seen_uids.update(result.uid for result in results.items)
+            changed = [result for result in results.items if needs_refresh(result, watermarks, checked)]
+            logger.info(f"Page {page_index}: {len(changed)} of {len(results.items)} items are new or modified")
+
+            records = [record for record in executor.map(retrieve_heritage_record, changed) if record is not None]
+            failed_uids = call_bulk_insert_stored_procedure(records, supabase)
+            # A canceled item that is still canceled keeps its stored date; remember the re-check so
+            # that it is not refetched every night until the listing shows a newer date
+            listed = {result.uid: normalize_date(listing_version(result)) or '' for result in changed}
+            checkpoint.mark_checked({record['uid']: listed[record['uid']] for record in records
+                                     if record['uid'] not in failed_uids
+                                     and watermarks.get(record['uid'], (None, False))[1]})
+            refreshed += len(records) - len(failed_uids)
+            failed += len(changed) - len(records) + len(failed_uids)
+            page_index += 1
+
+    # The walk takes minutes over offset pages; if the listing changed size meanwhile, items shifted
+    # onto pages that were already fetched and are missing from seen_uids
+    listing_stable = listing_complete
+    if listing_complete:
+        try:
+            final_hits = int(fetch_listing_page(1).hits)
+        except Exception as e:
+            logger.warning(f"Could not re-check the listing size: {e}")
+            final_hits = None
+        if final_hits != total_items:
+            logger.warning(f"Listing size changed from {total_items} to {final_hits} during the walk.")
+            listing_stable = False
+        elif len(seen_uids) < total_items:
+            logger.warning(f"Only {len(seen_uids)} of {total_items} listed uids were seen during the walk.")
+            listing_stable = False
+
+    # Only a complete walk of an unchanged listing tells which items really dropped out
+    if listing_stable:
+        active = [uid for uid, (_, canceled) in watermarks.items() if not canceled]
+        dropped = sorted(uid for uid in active if uid not in seen_uids)
+        if len(dropped) > MAX_CANCEL_FRACTION * len(active):
+            logger.critical(f"{len(dropped)} of {len(active)} active items dropped out of the listing. "
+                            f"Refusing to mark them as canceled.")
+        elif dropped:
+            mark_canceled(dropped, supabase)
+    elif listing_complete:
+        logger.warning("Listing changed during the walk. Skipping cancellation of dropped items.")
+    else:
+        logger.warning("Listing walk was incomplete. Skipping cancellation of dropped items.")
+
+    checkpoint.close()
+    logger.info(f"Incremental sync finished: {refreshed} items refreshed, {failed} failed.")
+    if failed or not listing_complete:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+from checkpoint import CrawlCheckpoint
+
+
+def test_resume_skips_completed_pages_without_failures():
+    checkpoint = CrawlCheckpoint(':memory:', 'init')
+    assert checkpoint.resume(25, 10) == [1, 2, 3]
+    checkpoint.mark_page_completed(1)
+    checkpoint.mark_page_completed(2)
+    checkpoint.record_failure('uid-1', 2)
+    assert checkpoint.resume(25, 10) == [2, 3]
+
+
+def test_resume_discards_progress_when_total_changes():
+    checkpoint = CrawlCheckpoint(':memory:', 'init')
+    checkpoint.resume(25, 10)
+    checkpoint.mark_page_completed(1)
+    checkpoint.record_failure('uid-1', 1)
+    assert checkpoint.resume(31, 10) == [1, 2, 3, 4]
+    assert checkpoint.hits == 31
+    assert not checkpoint.failed_uids()
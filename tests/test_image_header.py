@@ -0,0 +1,67 @@
+import struct
+
+import pytest
+
+from image_header import probe_dimensions
+
+
+def jpeg(width, height):
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    dht = b'\xff\xc4' + struct.pack('>H', 5) + b'\x00\x00\x00'
+    sof0 = b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+    return b'\xff\xd8' + app0 + dht + sof0 + b'\xff\xda'
+
+
+def png(width, height):
+    ihdr = struct.pack('>II', width, height) + b'\x08\x02\x00\x00\x00'
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + ihdr + b'\x00\x00\x00\x00'
+
+
+def gif(width, height):
+    return b'GIF89a' + struct.pack('<HH', width, height) + b'\x00\x00\x00'
+
+
+def webp(chunk, payload):
+    return b'RIFF' + struct.pack('<I', 4 + 8 + len(payload)) + b'WEBP' + chunk + struct.pack('<I', len(payload)) + payload
+
+
+def webp_lossy(width, height):
+    # Frame tag, start code, then 14-bit sizes whose top two bits are the (ignored) scale
+    return webp(b'VP8 ', b'\x30\x01\x00' + b'\x9d\x01\x2a' + struct.pack('<HH', width | 0x4000, height))
+
+
+def webp_lossless(width, height):
+    return webp(b'VP8L', b'\x2f' + struct.pack('<I', (width - 1) | (height - 1) << 14))
+
+
+def webp_extended(width, height):
+    return webp(b'VP8X', b'\x10\x00\x00\x00' + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little'))
+
+
+@pytest.mark.parametrize('build', [jpeg, png, gif, webp_lossy, webp_lossless, webp_extended])
+def test_probe_dimensions(build):
+    assert tuple(probe_dimensions(build(640, 480))) == (640, 480)
+
+
+def test_jpeg_without_frame_header_before_scan():
+    data = jpeg(640, 480)
+    start_of_frame = data.index(b'\xff\xc0')
+    assert probe_dimensions(data[:start_of_frame] + b'\xff\xda\x00\x02') is None
+
+
+def test_jpeg_truncated_inside_frame_header():
+    data = jpeg(640, 480)
+    start_of_frame = data.index(b'\xff\xc0')
+    assert probe_dimensions(data[:start_of_frame + 7]) is None
+
+
+@pytest.mark.parametrize('build', [jpeg, png, gif, webp_lossy, webp_lossless, webp_extended])
+def test_truncated_header(build):
+    data = build(640, 480)
+    assert probe_dimensions(data[:len(data) // 2]) is None
+
+
+@pytest.mark.parametrize('data', [b'', b'\xff', b'\xff\xd8', b'\x89PNG', b'GIF89a', b'RIFF\x00\x00\x00\x00WEBP',
+                                  b'not an image at all'])
+def test_short_or_unknown_header(data):
+    assert probe_dimensions(data) is None
@@ -0,0 +1,32 @@
+import pytest
+
+from network import HTTPStatusError, http_status, is_retryable
+
+
+class APIError(Exception):
+    """Shaped like postgrest's APIError: a code, but no status or response."""
+
+    def __init__(self, code):
+        super().__init__(f"API error {code}")
+        self.code = code
+
+
+@pytest.mark.parametrize('code', ['429', '503', 'PGRST003'])
+def test_transient_api_error_is_retryable(code):
+    assert is_retryable(APIError(code), retry_unknown=False)
+
+
+@pytest.mark.parametrize('code', ['400', '23505', 'PGRST116'])
+def test_permanent_api_error_is_not_retryable(code):
+    assert not is_retryable(APIError(code), retry_unknown=False)
+
+
+def test_api_error_raised_from_http_status_error():
+    try:
+        try:
+            raise HTTPStatusError(503)
+        except HTTPStatusError as e:
+            raise APIError('PGRST116') from e
+    except APIError as e:
+        assert http_status(e) == 503
+        assert is_retryable(e, retry_unknown=False)
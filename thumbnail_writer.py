@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from supabase import Client
+
+from network import RetryPolicy, async_call_with_retry, supabase_limiter
+
+# Defaults
+FLUSH_ROWS = 100  # Buffered thumbnails that trigger a flush
+FLUSH_SECONDS = 5.0  # Longest time a result waits in the buffer
+FLUSH_RETRY_POLICY = RetryPolicy(max_retries=3)  # Backoff for the batch RPC
+
+
+class ThumbnailUpdateBuffer:
+    """
+    Async write-behind buffer for thumbnail results. Column updates (and, for
+    image_optimize.py, the rows of thumbnail_variants) are collected in memory
+    and written with one update_thumbnails_bulk RPC whenever FLUSH_ROWS
+    thumbnails are pending or FLUSH_SECONDS have passed, instead of one
+    request per image. A failed batch is logged and dropped: its thumbnails
+    still match the work-queue filter and are picked up by the next run.
+    """
+
+    def __init__(self, client: Client, max_rows: int = FLUSH_ROWS, max_delay: float = FLUSH_SECONDS):
+        self.client = client
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._rows: Dict[object, dict] = {}
+        self._variants: List[dict] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    async def __aenter__(self):
+        self._timer = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Cancelling the timer could interrupt a flush after it took the batch out of the
+        # buffer; stop it instead and let any flush in progress finish before the final one
+        self._stopping.set()
+        await self._timer
+        await self.flush()
+
+    async def add(self, thumbnail_id, fields: dict, variants: Optional[List[dict]] = None) -> None:
+        """Queue new column values for one thumbnail; flushes right away once the buffer is full."""
+        self._rows.setdefault(thumbnail_id, {'id': thumbnail_id}).update(fields)
+        if variants:
+            self._variants.extend({'thumbnail_id': thumbnail_id, **variant} for variant in variants)
+        if len(self._rows) >= self.max_rows:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._rows:
+                return
+            rows, variants = list(self._rows.values()), self._variants
+            self._rows, self._variants = {}, []
+            try:
+                request = self.client.rpc('update_thumbnails_bulk', {'p_rows': rows, 'p_variants': variants})
+                await async_call_with_retry(lambda: asyncio.to_thread(request.execute), supabase_limiter,
+                                            FLUSH_RETRY_POLICY, retry_unknown=False,
+                                            description=f"Flushing {len(rows)} thumbnail updates")
+                logging.info(f"Flushed updates for {len(rows)} thumbnails.")
+            except Exception as e:
+                logging.error(f"Error flushing updates for Thumbnail IDs {[row['id'] for row in rows]}: {e}")
+
+    async def _flush_periodically(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                await self.flush()